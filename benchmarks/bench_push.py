@@ -0,0 +1,300 @@
+"""Throughput and latency of the push endpoints against a local fake homeserver.
+
+Starts the fake homeserver, a real HassWebhook instance on top of a SQLite database and an aiohttp server with
+the plugin's routes, then drives one scenario after another and reports requests per second and p50/p99 latency.
+
+    python benchmarks/bench_push.py --requests 200 --concurrency 20 --latency-ms 10 --rate-limit 0.02
+    python benchmarks/bench_push.py --scenarios message,edit_crawl --history-depth 800
+"""
+import argparse
+import asyncio
+import io
+import math
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from base64 import b64encode
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from aiohttp import ClientSession, web
+from mautrix.client.state_store import MemoryStateStore
+from mautrix.types import UserID
+from mautrix.util.config import RecursiveDict
+from mautrix.util.logging import TraceLogger  # noqa: F401 (registers the trace log level)
+from ruamel.yaml import YAML
+from ruamel.yaml.comments import CommentedMap
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from fake_homeserver import BOT_MXID, FakeHomeserver, serve, get_port  # noqa: E402
+from hasswebhook.bot import HassWebhook  # noqa: E402
+from hasswebhook.config import Config  # noqa: E402
+from maubot.matrix import MaubotMatrixClient  # noqa: E402
+
+ROOM_ID = "!bench:bench.local"
+CRAWL_ROOM_ID = "!crawl:bench.local"
+GROUP_ROOM_IDS = [f"!group{i}:bench.local" for i in range(10)]
+IMAGE_SIZES = {"image_64k": 150, "image_1m": 600, "image_5m": 1300}
+
+
+# The fake homeserver doesn't encrypt, so "decrypting" returns the event as it is
+class PlaintextCrypto:
+    async def decrypt_megolm_event(self, evt):
+        return evt
+
+
+def load_config(overrides: Dict[str, object]) -> Config:
+    base_path = os.path.join(os.path.dirname(__file__), "..", "base-config.yaml")
+    with open(base_path) as file:
+        base = YAML().load(file)
+    config = Config(load=lambda: CommentedMap(), load_base=lambda: RecursiveDict(base, CommentedMap),
+                    save=lambda data: None)
+    config.load_and_update = lambda: None
+    config.load()
+    config.update()
+    for key, value in overrides.items():
+        config[key] = value
+    return config
+
+
+def make_png(side: int) -> bytes:
+    from PIL import Image
+    img = Image.frombytes("RGB", (side, side), os.urandom(side * side * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+class Bench:
+    homeserver: FakeHomeserver
+    plugin: HassWebhook
+    session: ClientSession
+    base_url: str
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.homeserver = FakeHomeserver(args.latency_ms, args.rate_limit, args.retry_after_ms)
+        self.runners = []
+
+    async def setup(self) -> None:
+        hs_runner = await serve(self.homeserver)
+        self.runners.append(hs_runner)
+        self.session = ClientSession()
+
+        log = logging.getLogger("bench")
+        client = MaubotMatrixClient(mxid=UserID(BOT_MXID), base_url=f"http://127.0.0.1:{get_port(hs_runner)}",
+                                    token="bench", client_session=self.session, log=log.getChild("client"),
+                                    state_store=MemoryStateStore())
+        client.crypto = PlaintextCrypto()
+        db_path = os.path.join(tempfile.mkdtemp(prefix="hasswebhook-bench-"), "bench.db")
+        config = load_config({"image.cache_size": self.args.media_cache, "ratelimit.rate": self.args.send_rate,
+                              "ratelimit.room_rate": self.args.room_rate, "groups.rooms": {"bench": GROUP_ROOM_IDS}})
+        self.plugin = HassWebhook(client=client, loop=asyncio.get_event_loop(), http=self.session,
+                                  instance_id="bench", log=log, config=config,
+                                  database=create_engine(f"sqlite:///{db_path}"), webapp=None, webapp_url=None,
+                                  loader=None)
+        await self.plugin.start()
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/push/{room_id}", self.plugin.post_data)
+        app.router.add_post("/push/group/{name}", self.plugin.post_group)
+        app.router.add_post("/push/{room_id}/batch", self.plugin.post_batch)
+        plugin_runner = web.AppRunner(app, access_log=None)
+        await plugin_runner.setup()
+        await web.TCPSite(plugin_runner, "127.0.0.1", 0).start()
+        self.runners.append(plugin_runner)
+        self.base_url = f"http://127.0.0.1:{get_port(plugin_runner)}"
+
+        self.homeserver.seed_room(CRAWL_ROOM_ID, self.args.history_size, identifier="crawl.target",
+                                  depth=self.args.history_depth)
+
+    async def teardown(self) -> None:
+        await self.plugin.stop()
+        await self.session.close()
+        for runner in self.runners:
+            await runner.cleanup()
+
+    async def push(self, room_id: str, data: dict, path: str = "/push/") -> dict:
+        async with self.session.post(f"{self.base_url}{path}{room_id}", json=data) as resp:
+            if resp.status >= 300:
+                raise RuntimeError(f"HTTP {resp.status}: {await resp.text()}")
+            result = await resp.json() if resp.content_type == "application/json" else {}
+        failed = [room_id for room_id, room in result.get("rooms", {}).items() if not room["success"]]
+        if failed:
+            raise RuntimeError(f"Failed in {len(failed)} rooms: {result['rooms'][failed[0]]}")
+        return result
+
+    async def drive(self, name: str, make_request: Callable[[int], Awaitable[object]],
+                    count: Optional[int] = None) -> dict:
+        count = count or self.args.requests
+        latencies: List[float] = []
+        errors = 0
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+        rate_limited_before = sum(self.homeserver.rate_limited.values())
+
+        async def run(i: int) -> None:
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await make_request(i)
+                except Exception as e:
+                    errors += 1
+                    logging.getLogger("bench").debug(f"{name} request {i} failed: {e}")
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(run(i) for i in range(count)))
+        duration = time.perf_counter() - start
+        return report(name, latencies, duration, errors,
+                      sum(self.homeserver.rate_limited.values()) - rate_limited_before)
+
+    async def scenario_message(self) -> dict:
+        return await self.drive("message", lambda i: self.push(ROOM_ID, {
+            "message": f"Message {i}", "identifier": f"bench.message.{i}"}))
+
+    async def scenario_edit(self) -> dict:
+        await self.push(ROOM_ID, {"message": "Status", "identifier": "bench.edit"})
+        return await self.drive("edit", lambda i: self.push(ROOM_ID, {
+            "type": "edit", "message": f"Status {i}", "identifier": "bench.edit"}))
+
+    async def scenario_edit_crawl(self) -> dict:
+        return await self.drive(f"edit_crawl(depth={self.args.history_depth})", lambda i: self.push(
+            CRAWL_ROOM_ID, {"type": "edit", "message": f"Status {i}", "identifier": "crawl.target"}),
+            count=max(1, self.args.requests // 10))
+
+    async def scenario_reaction(self) -> dict:
+        await self.push(ROOM_ID, {"message": "React here", "identifier": "bench.reaction"})
+        return await self.drive("reaction", lambda i: self.push(ROOM_ID, {
+            "type": "reaction", "message": "👍", "identifier": "bench.reaction"}))
+
+    async def scenario_redaction(self) -> dict:
+        event_ids = [self.homeserver.add_event(ROOM_ID, {"type": "m.room.message", "content": {
+            "msgtype": "m.text", "body": f"Redact me {i}"}})["event_id"] for i in range(self.args.requests)]
+        return await self.drive("redaction", lambda i: self.push(ROOM_ID, {
+            "type": "redaction", "identifier": f"event_id.{event_ids[i]}"}))
+
+    async def scenario_batch(self) -> dict:
+        return await self.drive("batch(message+edit+reaction)", lambda i: self.push_batch(ROOM_ID, [
+            {"message": f"Batch {i}", "identifier": f"bench.batch.{i}"},
+            {"type": "edit", "message": f"Batch {i} edited", "identifier": f"bench.batch.{i}"},
+            {"type": "reaction", "message": "✅", "identifier": f"bench.batch.{i}"},
+        ]))
+
+    async def push_batch(self, room_id: str, operations: List[dict]) -> dict:
+        async with self.session.post(f"{self.base_url}/push/{room_id}/batch", json=operations) as resp:
+            if resp.status >= 300:
+                raise RuntimeError(f"HTTP {resp.status}: {await resp.text()}")
+            return await resp.json()
+
+    async def scenario_group(self) -> List[dict]:
+        image = b64encode(make_png(IMAGE_SIZES["image_1m"])).decode()
+        return [
+            await self.drive(f"group_message({len(GROUP_ROOM_IDS)} rooms)", lambda i: self.push(
+                "bench", {"message": f"Alarm {i}", "identifier": f"bench.group.{i}"}, path="/push/group/"),
+                count=max(1, self.args.requests // 10)),
+            await self.drive(f"group_image_1m({len(GROUP_ROOM_IDS)} rooms)", lambda i: self.push(
+                "bench", {"type": "image", "content": image, "contentType": "image/png", "name": "alarm.png"},
+                path="/push/group/"), count=max(1, self.args.requests // 20)),
+        ]
+
+    async def scenario_images(self) -> List[dict]:
+        results = []
+        for name, side in IMAGE_SIZES.items():
+            images = [b64encode(make_png(side)).decode() for _ in range(min(8, self.args.requests))]
+            count = max(1, self.args.requests // 10)
+            results.append(await self.drive(f"{name}({len(images[0]) // 1024}KiB b64)", lambda i: self.push(
+                ROOM_ID, {"type": "image", "content": images[i % len(images)], "contentType": "image/png",
+                          "name": "bench.png"}), count=count))
+        return results
+
+    async def scenario_lifetime_storm(self) -> dict:
+        from datetime import datetime, timedelta
+        import pytz
+        from hasswebhook.db import LifetimeEnd
+
+        count = self.args.storm_size
+        scheduler = self.plugin.lifetime_scheduler
+        done_before = scheduler.stats.expired + scheduler.stats.failed
+        failed_before = scheduler.stats.failed
+        rate_limited_before = sum(self.homeserver.rate_limited.values())
+        past = datetime.now(tz=pytz.UTC) - timedelta(minutes=5)
+        start = time.perf_counter()
+        await self.plugin.db.insert_many([LifetimeEnd(end_date=past, room_id=ROOM_ID, event_id=f"$storm{i}")
+                                          for i in range(count)])
+        while scheduler.stats.expired + scheduler.stats.failed - done_before < count:
+            await asyncio.sleep(0.01)
+        duration = time.perf_counter() - start
+        # Latency of a row is the time from the insert until the homeserver saw its redaction
+        redacted_at = self.homeserver.redacted_at
+        latencies = [redacted_at[f"$storm{i}"] - start for i in range(count) if f"$storm{i}" in redacted_at]
+        row = report(f"lifetime_storm({count})", latencies, duration, scheduler.stats.failed - failed_before,
+                     sum(self.homeserver.rate_limited.values()) - rate_limited_before)
+        row.update(requests=count, rps=round(count / duration, 1))
+        return row
+
+
+def report(name: str, latencies: List[float], duration: float, errors: int, rate_limited: int) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "scenario": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "rate_limited": rate_limited,
+        "rps": round(len(latencies) / duration, 1),
+        "p50_ms": round(statistics.median(latencies) * 1000, 1) if latencies else None,
+        "p99_ms": round(latencies[min(len(latencies) - 1, math.ceil(len(latencies) * 0.99) - 1)] * 1000, 1)
+        if latencies else None,
+    }
+
+
+def print_table(rows: List[dict]) -> None:
+    columns = ["scenario", "requests", "errors", "rate_limited", "rps", "p50_ms", "p99_ms"]
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print("  ".join(column.ljust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(str(row[column]).ljust(widths[column]) for column in columns))
+
+
+SCENARIOS = ["message", "edit", "edit_crawl", "reaction", "redaction", "batch", "group", "images", "lifetime_storm"]
+
+
+async def main(args: argparse.Namespace) -> None:
+    random.seed(0)
+    bench = Bench(args)
+    await bench.setup()
+    rows = []
+    try:
+        for scenario in args.scenarios.split(","):
+            result = await getattr(bench, f"scenario_{scenario}")()
+            rows.extend(result if isinstance(result, list) else [result])
+    finally:
+        await bench.teardown()
+    print_table(rows)
+    print(f"Homeserver requests: {dict(bench.homeserver.requests)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=5, help="Added to every homeserver request")
+    parser.add_argument("--rate-limit", type=float, default=0, help="Share of homeserver requests answered with 429")
+    parser.add_argument("--retry-after-ms", type=int, default=100,
+                        help="retry_after_ms the fake homeserver puts in 429 bodies (the bot backs off on its own)")
+    parser.add_argument("--history-size", type=int, default=1200, help="Events in the room searched by edit_crawl")
+    parser.add_argument("--history-depth", type=int, default=500, help="How far back the searched message is")
+    parser.add_argument("--storm-size", type=int, default=1000, help="Lifetime ends expiring at once")
+    parser.add_argument("--media-cache", type=int, default=0, help="image.cache_size, 0 uploads every image")
+    parser.add_argument("--send-rate", type=float, default=0, help="ratelimit.rate, 0 sends as fast as possible")
+    parser.add_argument("--room-rate", type=float, default=0, help="ratelimit.room_rate")
+    parser.add_argument("--log-level", default="WARNING")
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+    asyncio.get_event_loop().run_until_complete(main(args))
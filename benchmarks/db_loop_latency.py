@@ -0,0 +1,83 @@
+"""Event loop latency while lifetime ends are written, with and without the database executor.
+
+A ticker coroutine sleeps for 1 ms in a loop and records how late it wakes up. Meanwhile a burst of
+lifetime ends is inserted either directly on the loop (the old behaviour) or through LifetimeDatabase.
+
+    python benchmarks/db_loop_latency.py [--rows 2000] [--url sqlite:////tmp/hasswebhook-bench.db]
+"""
+import argparse
+import asyncio
+import math
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytz
+from sqlalchemy import create_engine
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hasswebhook.db import LifetimeDatabase, LifetimeEnd  # noqa: E402
+
+
+def make_rows(count: int):
+    end_date = datetime.now(tz=pytz.UTC) + timedelta(days=1)
+    return [LifetimeEnd(end_date=end_date, room_id="!bench:example.com", event_id=f"$event{i}")
+            for i in range(count)]
+
+
+async def measure(workload) -> dict:
+    lags = []
+    running = True
+
+    async def ticker() -> None:
+        while running:
+            start = time.perf_counter()
+            await asyncio.sleep(0.001)
+            lags.append((time.perf_counter() - start - 0.001) * 1000)
+
+    tick_task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(0.01)
+    start = time.perf_counter()
+    await workload()
+    duration = time.perf_counter() - start
+    running = False
+    await tick_task
+    lags.sort()
+    return {
+        "duration_s": round(duration, 3),
+        "lag_p50_ms": round(statistics.median(lags), 2),
+        "lag_p99_ms": round(lags[math.ceil(len(lags) * 0.99) - 1], 2),
+        "lag_max_ms": round(lags[-1], 2),
+    }
+
+
+async def main(url: str, rows: int) -> None:
+    engine = create_engine(url)
+    executor = ThreadPoolExecutor(max_workers=1)
+    db = LifetimeDatabase(engine, executor=executor)
+
+    async def blocking() -> None:
+        # What the plugin used to do: one synchronous execute per row, on the loop
+        for lifetime_end in make_rows(rows):
+            db._insert_rows([lifetime_end])
+            await asyncio.sleep(0)
+
+    async def offloaded() -> None:
+        await asyncio.gather(*(db.insert(lifetime_end) for lifetime_end in make_rows(rows)))
+
+    for name, workload in (("on event loop", blocking), ("executor + batching", offloaded)):
+        print(f"{name:>20}: {await measure(workload)}")
+    await db.remove_ids(row.id for row in await db.get_all())
+    executor.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--url", default="sqlite:////tmp/hasswebhook-bench.db")
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args.url, args.rows))
@@ -0,0 +1,161 @@
+"""A local stand-in for the parts of the Matrix client-server API the plugin uses.
+
+Serves send, redact, upload, messages, state, joined_members, sync and event with a configurable latency, and answers a configurable
+share of requests with M_LIMIT_EXCEEDED. Events are kept in memory and not encrypted.
+
+    python benchmarks/fake_homeserver.py --port 8008 --latency-ms 20 --rate-limit 0.05
+"""
+import argparse
+import asyncio
+import itertools
+import random
+import time
+from collections import Counter
+from typing import Dict, List
+
+from aiohttp import web
+
+BOT_MXID = "@bot:bench.local"
+
+
+class FakeHomeserver:
+    latency: float
+    rate_limit: float
+    retry_after_ms: int
+    timelines: Dict[str, List[dict]]
+    events: Dict[str, dict]
+    requests: Counter
+    rate_limited: Counter
+    redacted_at: Dict[str, float]  # perf_counter() of the first redaction of each event id
+
+    def __init__(self, latency_ms: float = 0, rate_limit: float = 0, retry_after_ms: int = 100) -> None:
+        self.latency = latency_ms / 1000
+        self.rate_limit = rate_limit
+        self.retry_after_ms = retry_after_ms
+        self.timelines = {}
+        self.events = {}
+        self.requests = Counter()
+        self.rate_limited = Counter()
+        self.redacted_at = {}
+        self.ids = itertools.count()
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.middleware], client_max_size=64 * 1024 * 1024)
+        prefix = "/_matrix/client/{version}"
+        app.router.add_put(prefix + "/rooms/{room_id}/send/{event_type}/{txn_id}", self.send)
+        app.router.add_put(prefix + "/rooms/{room_id}/redact/{event_id}/{txn_id}", self.redact)
+        app.router.add_get(prefix + "/rooms/{room_id}/messages", self.messages)
+        app.router.add_get(prefix + "/rooms/{room_id}/event/{event_id}", self.event)
+        app.router.add_get(prefix + "/rooms/{room_id}/state/{event_type}/{state_key:.*}", self.state)
+        app.router.add_get(prefix + "/rooms/{room_id}/joined_members", self.joined_members)
+        app.router.add_get(prefix + "/sync", self.sync)
+        app.router.add_post("/_matrix/media/{version}/upload", self.upload)
+        return app
+
+    @web.middleware
+    async def middleware(self, req: web.Request, handler) -> web.Response:
+        endpoint = handler.__name__
+        self.requests[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_limit and random.random() < self.rate_limit:
+            self.rate_limited[endpoint] += 1
+            return web.json_response({"errcode": "M_LIMIT_EXCEEDED", "error": "Too many requests",
+                                      "retry_after_ms": self.retry_after_ms}, status=429)
+        return await handler(req)
+
+    # Fills a room with history, the identifier is put into the message `depth` events back from the end
+    def seed_room(self, room_id: str, size: int, identifier: str = None, depth: int = 0) -> None:
+        for i in range(size):
+            body = f"History message {i}"
+            if identifier and i == size - 1 - depth:
+                body = f"Status by {identifier}"
+            self.add_event(room_id, {"type": "m.room.message", "content": {"msgtype": "m.text", "body": body}})
+
+    def add_event(self, room_id: str, event: dict) -> dict:
+        event = {
+            "event_id": f"$bench{next(self.ids)}",
+            "room_id": room_id,
+            "sender": BOT_MXID,
+            "origin_server_ts": int(time.time() * 1000),
+            "unsigned": {},
+            **event,
+        }
+        self.timelines.setdefault(room_id, []).append(event)
+        self.events[event["event_id"]] = event
+        return event
+
+    async def send(self, req: web.Request) -> web.Response:
+        event = self.add_event(req.match_info["room_id"], {"type": req.match_info["event_type"],
+                                                           "content": await req.json()})
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def redact(self, req: web.Request) -> web.Response:
+        self.redacted_at.setdefault(req.match_info["event_id"], time.perf_counter())
+        target = self.events.get(req.match_info["event_id"])
+        if target:
+            target["content"] = {}
+        event = self.add_event(req.match_info["room_id"], {"type": "m.room.redaction",
+                                                           "redacts": req.match_info["event_id"], "content": {}})
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def upload(self, req: web.Request) -> web.Response:
+        await req.read()
+        return web.json_response({"content_uri": f"mxc://bench.local/{next(self.ids)}"})
+
+    async def event(self, req: web.Request) -> web.Response:
+        event = self.events.get(req.match_info["event_id"])
+        if not event:
+            return web.json_response({"errcode": "M_NOT_FOUND", "error": "Event not found"}, status=404)
+        return web.json_response(event)
+
+    # Rooms have no state, which among other things means they're not encrypted
+    async def state(self, req: web.Request) -> web.Response:
+        return web.json_response({"errcode": "M_NOT_FOUND", "error": "Event not found"}, status=404)
+
+    async def joined_members(self, req: web.Request) -> web.Response:
+        return web.json_response({"joined": {BOT_MXID: {"display_name": "Bench bot", "avatar_url": None}}})
+
+    async def sync(self, req: web.Request) -> web.Response:
+        rooms = {room_id: {"timeline": {"events": [], "prev_batch": f"t_{len(timeline)}", "limited": False}}
+                 for room_id, timeline in self.timelines.items()}
+        return web.json_response({"next_batch": f"s_{next(self.ids)}", "rooms": {"join": rooms}})
+
+    # Pagination tokens are positions in the room timeline, no token means the end of the timeline
+    async def messages(self, req: web.Request) -> web.Response:
+        timeline = self.timelines.get(req.match_info["room_id"], [])
+        position = int(req.query.get("from", f"t_{len(timeline)}")[2:])
+        limit = int(req.query.get("limit", 10))
+        if req.query.get("dir", "b") == "b":
+            chunk = list(reversed(timeline[max(0, position - limit):position]))
+            end = max(0, position - limit)
+        else:
+            chunk = timeline[position:position + limit]
+            end = position + len(chunk)
+        return web.json_response({"start": f"t_{position}", "end": f"t_{end}", "chunk": chunk})
+
+
+async def serve(homeserver: FakeHomeserver, host: str = "127.0.0.1", port: int = 0) -> web.AppRunner:
+    runner = web.AppRunner(homeserver.make_app(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
+
+def get_port(runner: web.AppRunner) -> int:
+    return runner.addresses[0][1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8008)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--rate-limit", type=float, default=0, help="Share of requests answered with 429")
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(serve(FakeHomeserver(args.latency_ms, args.rate_limit), args.host, args.port))
+    print(f"Fake homeserver listening on http://{args.host}:{args.port}")
+    loop.run_forever()
@@ -0,0 +1,53 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Set
+
+from .roomposter import RoomPoster, RoomPosterType
+
+SEND_KEY = "send"
+
+
+# Operations that have to wait for each other: the same identifier (an edit needs its message first),
+# and everything that creates a new event, so the room timeline keeps the order of the batch
+def get_ordering_keys(room_poster: RoomPoster) -> Set[str]:
+    keys = set()
+    if room_poster.identifier:
+        keys.add(f"identifier:{room_poster.identifier}")
+    if room_poster.rp_type in (RoomPosterType.MESSAGE, RoomPosterType.IMAGE):
+        keys.add(SEND_KEY)
+    return keys
+
+
+# Runs the operations of a batch, each one after all earlier operations it shares an ordering key with.
+# Unrelated operations run concurrently. Returns the result or the exception of every operation.
+async def run_batch(room_posters: List[RoomPoster]) -> List[Any]:
+    last_by_key: Dict[str, asyncio.Future] = {}
+    tasks = []
+    for room_poster in room_posters:
+        keys = get_ordering_keys(room_poster)
+        predecessors = {last_by_key[key] for key in keys if key in last_by_key}
+        task = asyncio.ensure_future(run_after(predecessors, room_poster))
+        for key in keys:
+            last_by_key[key] = task
+        tasks.append(task)
+    return await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def run_after(predecessors: Set[asyncio.Future], room_poster: RoomPoster) -> Any:
+    if predecessors:
+        await asyncio.wait(predecessors)
+    return await room_poster.post_to_room()
+
+
+# Runs the same push in every room of a group, at most `concurrency` rooms at a time.
+# Returns the result or the exception for every room.
+async def run_fanout(room_posters: List[RoomPoster], concurrency: int,
+                     run: Callable[[RoomPoster], Awaitable[Any]] = RoomPoster.post_to_room) -> Dict[str, Any]:
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def run_limited(room_poster: RoomPoster) -> Any:
+        async with semaphore:
+            return await run(room_poster)
+
+    results = await asyncio.gather(*(run_limited(room_poster) for room_poster in room_posters),
+                                   return_exceptions=True)
+    return {room_poster.room_id: result for room_poster, result in zip(room_posters, results)}
@@ -1,63 +1,179 @@
 import asyncio
 import json
-from datetime import datetime, timedelta
-from typing import Type
+import multiprocessing
+import socket
+import uuid
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Type, Any, Awaitable, Callable, Optional
 
-import pytz
 from aiohttp.web import Request, Response
 from maubot import Plugin, MessageEvent
 from maubot.handlers import command, web
-from mautrix.types import TextMessageEventContent, Format, MessageType
+from mautrix.types import TextMessageEventContent, Format, MessageType, RoomID
 from mautrix.util import markdown
 
 from .config import Config
-from .db import LifetimeDatabase, LifetimeEnd
+from .db import LifetimeDatabase, LifetimeEnd, IdentifierDatabase, MediaCacheDatabase, CallbackSpoolDatabase, \
+    IdempotencyDatabase
+from .lifetime import LifetimeScheduler
 from .roomposter import RoomPoster, RoomPosterType, Image
 from .setupinstructions import HassWebhookSetupInstructions
+from .upload import is_upload, read_upload, read_limited, UploadTooLarge, CHUNK_SIZE
+from .batch import run_batch, run_fanout
+from .jobs import Job, JobQueue, JobStatus, QueueFull
+from .callbacks import CallbackDispatcher
+from .coalesce import Coalescer
+from .metrics import Metrics
+from .ratelimit import Priority, RateLimiter
+from .idempotency import IdempotencyCache, InvalidIdempotencyKey, IDEMPOTENCY_HEADER
+from .push import PushRequest, PushLog, InvalidPush, parse_bool
+from .warmup import Warmup, get_warmup_rooms
+
+
+# JSON result of one push, of every operation of a batch, or of every room of a group
+def format_result(result: Any) -> dict:
+    if isinstance(result, list):
+        return {"results": [format_result(item) for item in result]}
+    if isinstance(result, dict):
+        return {"rooms": {room_id: format_result(item) for room_id, item in result.items()}}
+    if isinstance(result, Exception):
+        return {"success": False, "error": str(result) or type(result).__name__}
+    if isinstance(result, str):
+        return {"success": True, "event_id": result}
+    return {"success": bool(result)}
 
 
 class HassWebhook(Plugin):
     config: Config
     db: LifetimeDatabase
+    identifier_db: IdentifierDatabase
+    media_cache: MediaCacheDatabase
+    lifetime_scheduler: LifetimeScheduler
+    db_executor: ThreadPoolExecutor
+    image_executor: Executor
+    decode_executor: Optional[Executor]
+    image_semaphore: asyncio.Semaphore
+    jobs: JobQueue
+    callbacks: CallbackDispatcher
+    coalescer: Coalescer
+    rate_limiter: RateLimiter
+    idempotency: IdempotencyCache
+    push_log: PushLog
+    warmup: Warmup
+    warmup_task: asyncio.Future
     loop_task: asyncio.Future
+    metrics: Metrics
 
     async def start(self) -> None:
         self.config.load_and_update()
-        self.db = LifetimeDatabase(self.database)
-        self.loop_task = asyncio.ensure_future(self.lifetime_loop(), loop=self.loop)
-
-    async def stop(self) -> None:
-        self.loop_task.cancel()
+        self.metrics = Metrics()
+        self.lifetime_scheduler = LifetimeScheduler(
+            on_expire=self.post_lifetime_end,
+            log=self.log,
+            concurrency=self.config["lifetime.concurrency"],
+            delete_batch_size=self.config["lifetime.delete_batch_size"],
+            max_attempts=self.config["lifetime.max_attempts"],
+            owner=f"{self.id}@{socket.gethostname()}:{uuid.uuid4().hex[:8]}",
+            lease_seconds=self.config["lifetime.lease_seconds"],
+            claim_batch_size=self.config["lifetime.claim_batch_size"],
+            poll_interval=self.config["lifetime.poll_interval"]
+        )
+        # A single thread keeps database access serialized, which is what SQLite wants anyway
+        self.db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="hasswebhook-db")
+        self.db = LifetimeDatabase(self.database, executor=self.db_executor, on_insert=self.lifetime_scheduler.push,
+                                   metrics=self.metrics)
+        self.identifier_db = IdentifierDatabase(self.database, executor=self.db_executor,
+                                                keep=self.config["history.index_keep"], metrics=self.metrics)
+        self.media_cache = MediaCacheDatabase(self.database, executor=self.db_executor,
+                                              max_entries=self.config["image.cache_size"], metrics=self.metrics)
+        self.idempotency = IdempotencyCache(IdempotencyDatabase(self.database, executor=self.db_executor,
+                                                                metrics=self.metrics),
+                                            log=self.log, ttl=self.config["idempotency.ttl"],
+                                            max_entries=self.config["idempotency.cache_size"])
+        await self.lifetime_scheduler.load(self.db)
+        self.image_executor = self.create_image_executor()
+        # base64 decoding and hashing stay in this process, so a process pool gets the image bytes only once
+        self.decode_executor = None if isinstance(self.image_executor, ProcessPoolExecutor) else self.image_executor
+        self.image_semaphore = asyncio.Semaphore(self.config["image.max_in_flight"])
+        callback_spool = CallbackSpoolDatabase(self.database, executor=self.db_executor, metrics=self.metrics) \
+            if self.config["callback.spool"] else None
+        self.callbacks = CallbackDispatcher(
+            log=self.log,
+            spool=callback_spool,
+            queue_size=self.config["callback.queue_size"],
+            workers=self.config["callback.workers"],
+            connections_per_host=self.config["callback.connections_per_host"],
+            timeout=self.config["callback.timeout"],
+            max_attempts=self.config["callback.max_attempts"],
+            metrics=self.metrics
+        )
+        await self.callbacks.start()
+        self.rate_limiter = RateLimiter(rate=self.config["ratelimit.rate"], burst=self.config["ratelimit.burst"],
+                                        room_rate=self.config["ratelimit.room_rate"],
+                                        room_burst=self.config["ratelimit.room_burst"])
+        self.push_log = PushLog(self.log, sample_rate=self.config["request.log_sample_rate"],
+                                max_length=self.config["request.log_max_length"])
+        self.coalescer = Coalescer(log=self.log, window=self.config["coalesce.window"])
+        self.jobs = JobQueue(log=self.log, max_room_depth=self.config["jobs.max_room_depth"],
+                             max_pending=self.config["jobs.max_pending"],
+                             keep_finished=self.config["jobs.keep_finished"])
+        self.loop_task = asyncio.ensure_future(self.lifetime_scheduler.run(), loop=self.loop)
+        if "batch" in (self.config["groups.rooms"] or {}):
+            self.log.warning("Room group 'batch' can't be pushed to, /push/group/batch is the batch endpoint. "
+                             "Please rename the group.")
+        self.warmup = Warmup(self.client, log=self.log, concurrency=self.config["warmup.concurrency"])
+        self.warmup_task = asyncio.ensure_future(self.run_warmup(), loop=self.loop)
+        self.metrics.lifetime_backlog.set_function(
+            lambda: len(self.lifetime_scheduler) + self.lifetime_scheduler.queue.qsize())
 
-    async def lifetime_loop(self) -> None:
+    # Runs in the background, pushes are accepted while rooms are warmed up
+    async def run_warmup(self) -> None:
+        if not self.config["warmup.enabled"]:
+            return
         try:
-            self.log.debug("Lifetime watcher loop started")
-            while True:
-                now = datetime.now(tz=pytz.UTC)
-                next_minute = (now + timedelta(minutes=1)).replace(second=0, microsecond=0)
-                await asyncio.sleep((next_minute - now).total_seconds())
-                await self.schedule_nearby_lifetime_ends(next_minute)
+            recent = await self.identifier_db.get_recent_rooms(self.config["warmup.recent_rooms"])
+            await self.warmup.run(get_warmup_rooms(self.config["warmup.rooms"], self.config["groups.rooms"], recent))
         except asyncio.CancelledError:
-            self.log.debug("Lifetime watcher loop stopped")
-        except Exception:
-            self.log.exception("Exception in lifetime watcher loop")
+            raise
+        except Exception as e:
+            self.warmup.stats.error = repr(e)
+            self.log.exception("Warm-up failed")
+
+    async def stop(self) -> None:
+        self.warmup_task.cancel()
+        await asyncio.wait([self.warmup_task])
+        await self.coalescer.stop()
+        await self.jobs.stop(self.config["jobs.stop_timeout"])
+        self.loop_task.cancel()
+        await asyncio.wait([self.loop_task])
+        await self.callbacks.stop()
+        self.rate_limiter.stop()
+        self.db_executor.shutdown(wait=True)
+        self.image_executor.shutdown(wait=False)
 
-    async def schedule_nearby_lifetime_ends(self, now: datetime) -> None:
-        until = now + timedelta(minutes=1)
-        for lifetime_end in self.db.get_older_than(until):
-            asyncio.create_task(self.post_lifetime_end(lifetime_end))
+    # Decoding, thumbnailing and encrypting images runs here instead of on the event loop.
+    # Worker processes have to be forked: the plugin is loaded from its .mbp archive, so spawn and forkserver
+    # workers can't import it.
+    def create_image_executor(self) -> Executor:
+        workers = self.config["image.workers"]
+        if self.config["image.executor"] == "process":
+            if "fork" in multiprocessing.get_all_start_methods():
+                return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"))
+            self.log.warning("image.executor: process needs the fork start method, using threads instead")
+        return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="hasswebhook-image")
 
-    async def post_lifetime_end(self, lifetime_end: LifetimeEnd) -> None:
-        self.db.remove(lifetime_end)
+    # The database row is removed by the scheduler once this returns, rate limit errors are raised to be retried
+    async def post_lifetime_end(self, lifetime_end: LifetimeEnd) -> bool:
         room_poster: RoomPoster = RoomPoster(
             hasswebhook=self,
             identifier=f"event_id.{lifetime_end.event_id}",
             rp_type=RoomPosterType.REDACTION,
-            room_id=lifetime_end.room_id
+            room_id=lifetime_end.room_id,
+            priority=Priority.LOW
         )
 
         self.log.debug(f"Lifetime ends for event with ID {lifetime_end.event_id}.")
-        await room_poster.post_to_room()
+        return await room_poster.post_to_room()
 
     def get_base_url(self) -> str:
         return self.config["base_url"]
@@ -71,6 +187,21 @@ class HassWebhook(Plugin):
     def get_message_key(self) -> str:
         return self.config["message_key"]
 
+    def get_history_search_depth(self) -> int:
+        return self.config["history.search_depth"]
+
+    def get_history_page_size(self) -> int:
+        return self.config["history.page_size"]
+
+    def get_ratelimit_max_retries(self) -> int:
+        return self.config["ratelimit.max_retries"]
+
+    def get_thumbnail_format(self) -> str:
+        return self.config["image.thumbnail_format"]
+
+    def get_thumbnail_quality(self) -> int:
+        return self.config["image.thumbnail_quality"]
+
     @command.new(name=get_command_prefix)
     async def setup_instructions(self, evt: MessageEvent) -> None:
         setup_instructions = HassWebhookSetupInstructions(
@@ -93,68 +224,275 @@ class HassWebhook(Plugin):
 
     @web.post("/push/{room_id}")
     async def post_data(self, req: Request) -> Response:
+        with self.metrics.track_in_flight():
+            return await self.handle_push(req)
+
+    async def handle_push(self, req: Request) -> Response:
         room_id: str = req.match_info["room_id"]
-        self.log.info(f"Request for room {room_id} data: {await req.text()}")
+        if is_upload(req):
+            return await self.post_upload(room_id, req)
+        try:
+            with self.metrics.time("parse"):
+                push = PushRequest.parse(await self.read_json(req), self.get_message_key())
+        except UploadTooLarge:
+            return self.body_too_large()
+        except InvalidPush as e:
+            return self.bad_request(str(e))
+        self.push_log.push(room_id, push)
 
-        req_dict = await req.json()
-        self.log.debug(req_dict)
+        idempotency_key = req.headers.get(IDEMPOTENCY_HEADER) or push.idempotency_key
+        return await self.run_idempotent(room_id, idempotency_key, lambda: self.run_push(req, room_id, push))
 
-        message: str = req_dict.get(self.get_message_key())
-        rp_type: RoomPosterType = RoomPosterType.get_type_from_str(req_dict.get("type", "message"))
-        identifier: str = req_dict.get("identifier", "")
-        callback_url: str = req_dict.get("callback_url", "")
+    # The body is read once, up to request.max_body_size, and parsed once
+    async def read_json(self, req: Request) -> Any:
+        max_size = self.config["request.max_body_size"]
+        if req.content_length and req.content_length > max_size:
+            raise UploadTooLarge()
+        body = await read_limited(req.content.iter_chunked(CHUNK_SIZE), max_size)
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            raise InvalidPush(f"Invalid JSON: {e}")
 
-        lifetime: int = req_dict.get("lifetime", "")
-        if lifetime == "" or int(lifetime) < 0:
-            lifetime = -1
-        else:
-            lifetime = int(lifetime)
-        self.log.debug(f"Lifetime: {lifetime}")
-
-        # Image parameters
-        content: str = req_dict.get("content")
-        content_type: str = req_dict.get("contentType")
-        name: str = req_dict.get("name")
-        thumbnail_size: int = req_dict.get("thumbnailSize", 128)
-        image = None
-        self.log.info(content)
-        if not content and rp_type == RoomPosterType.IMAGE:
-            return Response(status=400, content_type="application/json", body=json.dumps(
-                {"success": False,
-                 "error": "Type is set to image. Please pass at least the 'content' property (base64 image)"}))
+    def bad_request(self, error: str) -> Response:
+        return Response(status=400, content_type="application/json",
+                        body=json.dumps({"success": False, "error": error}))
 
-        if content and rp_type != RoomPosterType.IMAGE:
-            rp_type = RoomPosterType.IMAGE
+    def body_too_large(self) -> Response:
+        return Response(status=413, content_type="application/json", body=json.dumps(
+            {"success": False, "error": f"Request body is larger than {self.config['request.max_body_size']} bytes"}))
 
-        if rp_type == RoomPosterType.IMAGE:
-            image = Image(content=content, content_type=content_type, name=name, thumbnail_size=thumbnail_size)
-            self.log.info(f"Image content found: {content}")
+    # Pushes with an idempotency key are only executed once, retries get the response of the first one
+    async def run_idempotent(self, room_id: str, idempotency_key: Optional[str],
+                             handler: Callable[[], Awaitable[Response]]) -> Response:
+        if not idempotency_key:
+            return await handler()
+        try:
+            return await self.idempotency.run(RoomID(room_id), str(idempotency_key), handler)
+        except InvalidIdempotencyKey as e:
+            return self.bad_request(str(e))
 
-        room_poster: RoomPoster = RoomPoster(
-            hasswebhook=self,
-            message=message,
-            identifier=identifier,
-            rp_type=rp_type,
-            room_id=room_id,
-            callback_url=callback_url,
-            lifetime=lifetime,
-            image=image,
-        )
+    async def run_push(self, req: Request, room_id: str, push: PushRequest) -> Response:
+        room_poster: RoomPoster = self.create_room_poster(room_id, push)
+        rp_type = room_poster.rp_type
 
-        self.log.debug(f"Received data with ID {room_id}: {req_dict}")
+        if self.wants_async(req, push.run_async):
+            if self.jobs.is_full(room_id):
+                return self.reject_job(room_id)
+            job = self.submit_push(room_poster)
+            return Response(status=202, content_type="application/json",
+                            body=json.dumps({"job_id": job.id, "status": job.status.value}))
 
-        event_id = await room_poster.post_to_room()
+        event_id = await self.coalescer.run(room_poster)
+        merged = {"merged": room_poster.merged} if room_poster.merged else {}
         if rp_type == RoomPosterType.MESSAGE or rp_type == RoomPosterType.IMAGE:
-            return Response(status=200, body=json.dumps({"event_id": event_id}), content_type="application/json")
+            return Response(status=200, body=json.dumps({"event_id": event_id, **merged}),
+                            content_type="application/json")
+        elif event_id and merged:
+            return Response(status=200, body=json.dumps(merged), content_type="application/json")
         elif event_id:
             return Response(status=200)
         else:
             return Response(status=404)
 
+    # Builds the RoomPoster for one push, shared by all endpoints
+    def create_room_poster(self, room_id: str, push: PushRequest) -> RoomPoster:
+        image = None
+        if push.rp_type == RoomPosterType.IMAGE:
+            image = Image(content=push.content, content_type=push.content_type, name=push.name,
+                          thumbnail_size=push.thumbnail_size)
+        return RoomPoster(
+            hasswebhook=self,
+            message=push.message,
+            identifier=push.identifier,
+            rp_type=push.rp_type,
+            room_id=room_id,
+            callback_url=push.callback_url,
+            lifetime=push.lifetime,
+            image=image,
+            priority=push.priority,
+        )
+
+    # Runs several pushes for one room in a single request, see batch.run_batch for the ordering rules
+    @web.post("/push/{room_id}/batch")
+    async def post_batch(self, req: Request) -> Response:
+        with self.metrics.track_in_flight():
+            return await self.handle_batch(req)
+
+    async def handle_batch(self, req: Request) -> Response:
+        room_id: str = req.match_info["room_id"]
+        if room_id == "group":
+            # /push/group/batch ends up here, not at post_group
+            return self.bad_request("Room groups can't be named 'batch', please rename the group")
+        try:
+            req_list = await self.read_json(req)
+        except UploadTooLarge:
+            return self.body_too_large()
+        except InvalidPush as e:
+            return self.bad_request(str(e))
+        run_async = None
+        if isinstance(req_list, dict):
+            run_async = parse_bool(req_list.get("async"))
+            req_list = req_list.get("operations")
+        if not isinstance(req_list, list):
+            return self.bad_request("Please pass a list of operations")
+        self.log.info(f"Batch request for room {room_id} with {len(req_list)} operations")
+
+        room_posters = []
+        for index, req_dict in enumerate(req_list):
+            try:
+                push = PushRequest.parse(req_dict, self.get_message_key())
+                self.push_log.push(room_id, push)
+                room_posters.append(self.create_room_poster(room_id, push))
+            except InvalidPush as e:
+                return self.bad_request(f"Operation {index}: {e}")
+
+        if self.wants_async(req, run_async):
+            return self.accept_job(room_id, lambda: run_batch(room_posters))
+
+        results = await run_batch(room_posters)
+        for result in results:
+            if isinstance(result, Exception):
+                self.log.warning(f"Batch operation for room {room_id} failed: {result!r}")
+        return Response(status=200, body=json.dumps(format_result(results)), content_type="application/json")
+
+    # Sends one push to every room of a group configured in groups.rooms. Images are uploaded only once.
+    @web.post("/push/group/{name}")
+    async def post_group(self, req: Request) -> Response:
+        with self.metrics.track_in_flight():
+            return await self.handle_group(req)
+
+    async def handle_group(self, req: Request) -> Response:
+        name: str = req.match_info["name"]
+        room_ids = (self.config["groups.rooms"] or {}).get(name)
+        if not room_ids:
+            return Response(status=404, content_type="application/json", body=json.dumps(
+                {"success": False, "error": f"Unknown room group '{name}'"}))
+        try:
+            with self.metrics.time("parse"):
+                push = PushRequest.parse(await self.read_json(req), self.get_message_key())
+        except UploadTooLarge:
+            return self.body_too_large()
+        except InvalidPush as e:
+            return self.bad_request(str(e))
+        group_key = f"group:{name}"
+        self.push_log.push(group_key, push)
+
+        room_posters = [self.create_room_poster(room_id, push) for room_id in room_ids]
+        for room_poster in room_posters[1:]:
+            room_poster.image = room_posters[0].image
+
+        async def run_group() -> Any:
+            return await run_fanout(room_posters, self.config["groups.concurrency"], self.coalescer.run)
+
+        async def post_to_group() -> Response:
+            if self.wants_async(req, push.run_async):
+                # Every room gets its own job on its own queue, so the push keeps its order with the other
+                # pushes to that room
+                full = [room_id for room_id in room_ids if self.jobs.is_full(room_id, len(room_ids))]
+                if full:
+                    return self.reject_job(full[0])
+                jobs = {room_poster.room_id: self.submit_push(room_poster).id for room_poster in room_posters}
+                return Response(status=202, content_type="application/json",
+                                body=json.dumps({"jobs": jobs, "status": JobStatus.QUEUED.value}))
+            results = await run_group()
+            for room_id, result in results.items():
+                if isinstance(result, Exception):
+                    self.log.warning(f"Push to room {room_id} of group {name} failed: {result!r}")
+            return Response(status=200, body=json.dumps(format_result(results)), content_type="application/json")
+
+        idempotency_key = req.headers.get(IDEMPOTENCY_HEADER) or push.idempotency_key
+        return await self.run_idempotent(group_key, idempotency_key, post_to_group)
+
+    # Pushes can ask to be answered right away with 202 and a job id instead of waiting for the homeserver
+    def wants_async(self, req: Request, requested: Optional[bool] = None) -> bool:
+        if "async" in req.query:
+            return parse_bool(req.query["async"])
+        if requested is None:
+            return self.config["jobs.async_by_default"]
+        return requested
+
+    # Queues a single push on its room's queue, the caller checks that the queue has room for it.
+    # Coalesced pushes join their window right away, but the window is only sent once the room queue gets to the
+    # job, so it doesn't overtake pushes queued before it.
+    def submit_push(self, room_poster: RoomPoster) -> Job:
+        if not self.coalescer.is_coalesced(room_poster):
+            return self.jobs.submit(room_poster.room_id, room_poster.post_to_room)
+        turn = asyncio.get_event_loop().create_future()
+
+        async def run_coalesced() -> Any:
+            if not turn.done():
+                turn.set_result(None)
+            return await coalesced
+        job = self.jobs.submit(room_poster.room_id, run_coalesced)
+        coalesced = asyncio.ensure_future(self.coalescer.run(room_poster, turn))
+        return job
+
+    def accept_job(self, room_id: str, run: Callable[[], Awaitable[Any]]) -> Response:
+        try:
+            job = self.jobs.submit(room_id, run)
+        except QueueFull:
+            return self.reject_job(room_id)
+        return Response(status=202, content_type="application/json",
+                        body=json.dumps({"job_id": job.id, "status": job.status.value}))
+
+    def reject_job(self, room_id: str) -> Response:
+        self.log.warning(f"Job queue full, rejecting push for room {room_id}")
+        return Response(status=503, headers={"Retry-After": "1"}, content_type="application/json",
+                        body=json.dumps({"success": False, "error": "Too many pending pushes, try again later"}))
+
+    @web.get("/jobs/{job_id}")
+    async def job_status(self, req: Request) -> Response:
+        job = self.jobs.get(req.match_info["job_id"])
+        if not job:
+            return Response(status=404)
+        status = {"job_id": job.id, "room_id": job.room_id, "status": job.status.value}
+        if job.status == JobStatus.DONE:
+            status["result"] = format_result(job.result)
+        elif job.status == JobStatus.FAILED:
+            status["error"] = job.error
+        return Response(status=200, body=json.dumps(status), content_type="application/json")
+
+    # Images sent as raw image/* body or multipart/form-data instead of base64 inside JSON
+    async def post_upload(self, room_id: str, req: Request) -> Response:
+        try:
+            upload = await read_upload(req, self.config["image.max_upload_size"])
+        except UploadTooLarge:
+            return Response(status=413, content_type="application/json", body=json.dumps(
+                {"success": False,
+                 "error": f"Image is larger than {self.config['image.max_upload_size']} bytes"}))
+        if not upload.data:
+            return self.bad_request("Please send the image as request body or as a file in the form")
+
+        try:
+            push = PushRequest.parse({**upload.fields, "type": "image"}, self.get_message_key(), content=upload.data)
+        except InvalidPush as e:
+            return self.bad_request(str(e))
+        push.content_type = upload.content_type
+        push.name = push.name or upload.filename or "image"
+        self.push_log.push(room_id, push)
+
+        # Uploads pass async as form field or in the query string, like their other parameters
+        idempotency_key = req.headers.get(IDEMPOTENCY_HEADER) or push.idempotency_key
+        return await self.run_idempotent(room_id, idempotency_key, lambda: self.run_push(req, room_id, push))
+
     @web.get("/health")
     async def health(self, req: Request) -> Response:
         return Response(status=200)
 
+    @web.get("/metrics")
+    async def get_metrics(self, req: Request) -> Response:
+        return Response(status=200, text=self.metrics.render(), content_type="text/plain", charset="utf-8")
+
+    @web.get("/warmup")
+    async def warmup_stats(self, req: Request) -> Response:
+        return Response(status=200, body=json.dumps(self.warmup.stats.as_dict()), content_type="application/json")
+
+    @web.get("/lifetime")
+    async def lifetime_stats(self, req: Request) -> Response:
+        return Response(status=200, body=json.dumps(self.lifetime_scheduler.get_stats().as_dict()),
+                        content_type="application/json")
+
     @classmethod
     def get_config_class(cls) -> Type[Config]:
         return Config
@@ -0,0 +1,131 @@
+import asyncio
+from logging import Logger
+from typing import List, Optional, Tuple
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector, ClientError
+from attr import dataclass
+
+from .db import CallbackSpoolDatabase, SpooledCallback
+from .metrics import Metrics
+from .ratelimit import get_backoff
+
+
+@dataclass
+class Callback:
+    url: str
+    payload: dict
+    attempts: int = 0
+
+
+# Delivers callbacks in the background, so a slow or unreachable callback target never holds up a push.
+# Failed deliveries are retried with exponential backoff. With a spool, callbacks that are still pending
+# when the plugin stops, including the ones interrupted mid-delivery, are stored and sent after the next start.
+class CallbackDispatcher:
+    queue: "asyncio.Queue[Callback]"
+    session: Optional[ClientSession]
+    workers: List[asyncio.Task]
+    in_flight: List[Callback]
+    retries: List[Tuple[asyncio.TimerHandle, Callback]]
+    spool: Optional[CallbackSpoolDatabase]
+    log: Logger
+    worker_count: int
+    connections_per_host: int
+    timeout: float
+    max_attempts: int
+    metrics: Metrics
+
+    def __init__(self, log: Logger, spool: Optional[CallbackSpoolDatabase] = None, queue_size: int = 1000,
+                 workers: int = 4, connections_per_host: int = 4, timeout: float = 10, max_attempts: int = 5,
+                 metrics: Optional[Metrics] = None) -> None:
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.session = None
+        self.workers = []
+        self.in_flight = []
+        self.retries = []
+        self.spool = spool
+        self.log = log
+        self.worker_count = max(1, workers)
+        self.connections_per_host = connections_per_host
+        self.timeout = timeout
+        self.max_attempts = max(1, max_attempts)
+        self.metrics = metrics or Metrics()
+
+    async def start(self) -> None:
+        self.session = ClientSession(connector=TCPConnector(limit_per_host=self.connections_per_host),
+                                     timeout=ClientTimeout(total=self.timeout))
+        self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.worker_count)]
+        if self.spool:
+            spooled = await self.spool.pop_all()
+            if spooled:
+                self.log.info(f"Sending {len(spooled)} callbacks spooled before the last stop")
+            for entry in spooled:
+                self.enqueue(Callback(url=entry.url, payload=entry.payload, attempts=entry.attempts))
+
+    def submit(self, url: str, payload: dict) -> None:
+        self.enqueue(Callback(url=url, payload=payload))
+
+    def enqueue(self, callback: Callback) -> None:
+        try:
+            self.queue.put_nowait(callback)
+        except asyncio.QueueFull:
+            self.log.warning(f"Callback queue full, dropping callback to {callback.url}")
+
+    async def worker(self) -> None:
+        while True:
+            callback = await self.queue.get()
+            self.in_flight.append(callback)
+            try:
+                await self.deliver(callback)
+            except Exception:
+                self.log.exception(f"Exception while sending callback to {callback.url}")
+            finally:
+                self.queue.task_done()
+            # Callbacks interrupted by stop() stay in in_flight and are spooled
+            self.in_flight.remove(callback)
+
+    async def deliver(self, callback: Callback) -> None:
+        callback.attempts += 1
+        try:
+            with self.metrics.time("callback"):
+                async with self.session.post(callback.url, json=callback.payload) as resp:
+                    if resp.status < 500 and resp.status != 429:
+                        if resp.status >= 400:
+                            self.log.warning(f"Callback to {callback.url} was rejected with HTTP {resp.status}")
+                        return
+                    error = f"HTTP {resp.status}"
+        except (ClientError, asyncio.TimeoutError) as e:
+            error = str(e) or type(e).__name__
+        self.metrics.failures.inc(type="callback")
+
+        if callback.attempts >= self.max_attempts:
+            self.log.error(f"Giving up on callback to {callback.url} after {callback.attempts} attempts: {error}")
+            return
+        delay = get_backoff(callback.attempts)
+        self.log.debug(f"Callback to {callback.url} failed ({error}), retrying in {delay}s")
+        handle = asyncio.get_event_loop().call_later(delay, self.retry, callback)
+        self.retries.append((handle, callback))
+
+    def retry(self, callback: Callback) -> None:
+        self.retries = [(handle, waiting) for handle, waiting in self.retries if waiting is not callback]
+        self.enqueue(callback)
+
+    async def stop(self) -> None:
+        pending = []
+        for handle, callback in self.retries:
+            handle.cancel()
+            pending.append(callback)
+        for worker in self.workers:
+            worker.cancel()
+        if self.workers:
+            await asyncio.wait(self.workers)
+        # The target may have got these already, sending them again is better than losing them
+        pending.extend(self.in_flight)
+        self.in_flight = []
+        while not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        if self.spool and pending:
+            self.log.info(f"Spooling {len(pending)} undelivered callbacks")
+            await self.spool.insert_many([SpooledCallback(url=callback.url, payload=callback.payload,
+                                                          attempts=callback.attempts) for callback in pending])
+        if self.session:
+            await self.session.close()
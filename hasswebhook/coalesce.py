@@ -0,0 +1,105 @@
+import asyncio
+from logging import Logger
+from typing import Any, Dict, Optional, Tuple
+
+from .roomposter import RoomPoster, RoomPosterType
+
+COALESCED_TYPES = (RoomPosterType.MESSAGE, RoomPosterType.EDIT)
+
+
+class PendingPush:
+    room_poster: RoomPoster
+    future: asyncio.Future
+    timer: Optional[asyncio.TimerHandle]
+    merged: int
+    previous: Optional[asyncio.Future]
+    turn: Optional[asyncio.Future]
+
+    def __init__(self, room_poster: RoomPoster, previous: Optional[asyncio.Future] = None,
+                 turn: Optional[asyncio.Future] = None) -> None:
+        self.room_poster = room_poster
+        self.future = asyncio.get_event_loop().create_future()
+        self.timer = None
+        self.merged = 0
+        self.previous = previous
+        self.turn = turn
+
+
+# Collapses messages and edits for the same identifier in a room that arrive within the window.
+# The first push opens the window, later ones replace its payload, and when the window closes only the
+# latest payload is sent. Every push of the window gets the result of that single send.
+# Windows for the same identifier in a room are sent in the order they were opened, whatever their type, so an
+# edit never overtakes the message it edits.
+class Coalescer:
+    window: float
+    pending: Dict[Tuple[str, str, RoomPosterType], PendingPush]
+    last: Dict[Tuple[str, str], asyncio.Future]
+    stopped: asyncio.Future
+    log: Logger
+
+    def __init__(self, log: Logger, window: float = 0) -> None:
+        self.window = window
+        self.pending = {}
+        self.last = {}
+        self.stopped = asyncio.get_event_loop().create_future()
+        self.log = log
+
+    def is_coalesced(self, room_poster: RoomPoster) -> bool:
+        return (self.window > 0 and room_poster.rp_type in COALESCED_TYPES and bool(room_poster.identifier)
+                and "event_id." not in room_poster.identifier)
+
+    # turn is awaited before the window is sent, async pushes pass one that resolves when the room's job queue
+    # gets to them, so they don't overtake pushes queued before them
+    async def run(self, room_poster: RoomPoster, turn: Optional[asyncio.Future] = None) -> Any:
+        if not self.is_coalesced(room_poster):
+            return await room_poster.post_to_room()
+
+        key = (room_poster.room_id, room_poster.identifier, room_poster.rp_type)
+        pending = self.pending.get(key)
+        if pending:
+            pending.room_poster = room_poster
+            pending.merged += 1
+        else:
+            order_key = (room_poster.room_id, room_poster.identifier)
+            pending = self.pending[key] = PendingPush(room_poster, self.last.get(order_key), turn)
+            self.last[order_key] = pending.future
+            pending.timer = asyncio.get_event_loop().call_later(
+                self.window, lambda: asyncio.ensure_future(self.flush(key)))
+
+        # Several pushes wait for the same send, one of them going away must not cancel it
+        result = await asyncio.shield(pending.future)
+        room_poster.merged = pending.merged
+        return result
+
+    async def flush(self, key: Tuple[str, str, RoomPosterType]) -> None:
+        pending = self.pending.pop(key, None)
+        if not pending:
+            return
+        if pending.timer:
+            pending.timer.cancel()
+        # Whether the earlier window succeeded doesn't matter, only that it was sent first
+        if pending.previous:
+            await asyncio.wait([pending.previous])
+        if pending.turn:
+            # Pushes still queued are sent right away when stopping, the job queue won't get to them anymore
+            await asyncio.wait([pending.turn, self.stopped], return_when=asyncio.FIRST_COMPLETED)
+        room_poster = pending.room_poster
+        room_poster.merged = pending.merged
+        if pending.merged:
+            self.log.debug(f"Merged {pending.merged} earlier pushes into the latest one for {room_poster.identifier}")
+        try:
+            pending.future.set_result(await room_poster.post_to_room())
+        except Exception as e:
+            pending.future.set_exception(e)
+        finally:
+            # Also when cancelled, so later windows for the identifier don't wait forever
+            if not pending.future.done():
+                pending.future.cancel()
+            order_key = (room_poster.room_id, room_poster.identifier)
+            if self.last.get(order_key) is pending.future:
+                del self.last[order_key]
+
+    async def stop(self) -> None:
+        if not self.stopped.done():
+            self.stopped.set_result(None)
+        await asyncio.gather(*(self.flush(key) for key in list(self.pending)), return_exceptions=True)
@@ -7,3 +7,47 @@ class Config(BaseProxyConfig):
         helper.copy("base_url")
         helper.copy("keep_del_tag")
         helper.copy("message_key")
+        helper.copy("lifetime.concurrency")
+        helper.copy("lifetime.delete_batch_size")
+        helper.copy("lifetime.max_attempts")
+        helper.copy("lifetime.lease_seconds")
+        helper.copy("lifetime.claim_batch_size")
+        helper.copy("lifetime.poll_interval")
+        helper.copy("image.executor")
+        helper.copy("image.workers")
+        helper.copy("image.max_in_flight")
+        helper.copy("image.max_upload_size")
+        helper.copy("image.cache_size")
+        helper.copy("image.thumbnail_format")
+        helper.copy("image.thumbnail_quality")
+        helper.copy("jobs.async_by_default")
+        helper.copy("jobs.max_room_depth")
+        helper.copy("jobs.max_pending")
+        helper.copy("jobs.keep_finished")
+        helper.copy("jobs.stop_timeout")
+        helper.copy("callback.timeout")
+        helper.copy("callback.max_attempts")
+        helper.copy("callback.queue_size")
+        helper.copy("callback.workers")
+        helper.copy("callback.connections_per_host")
+        helper.copy("callback.spool")
+        helper.copy("coalesce.window")
+        helper.copy("history.search_depth")
+        helper.copy("history.page_size")
+        helper.copy("history.index_keep")
+        helper.copy("ratelimit.rate")
+        helper.copy("ratelimit.burst")
+        helper.copy("ratelimit.room_rate")
+        helper.copy("ratelimit.room_burst")
+        helper.copy("ratelimit.max_retries")
+        helper.copy("idempotency.ttl")
+        helper.copy("idempotency.cache_size")
+        helper.copy("request.max_body_size")
+        helper.copy("request.log_sample_rate")
+        helper.copy("request.log_max_length")
+        helper.copy("groups.concurrency")
+        helper.copy("groups.rooms")
+        helper.copy("warmup.enabled")
+        helper.copy("warmup.concurrency")
+        helper.copy("warmup.rooms")
+        helper.copy("warmup.recent_rooms")
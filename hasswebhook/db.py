@@ -1,14 +1,52 @@
+import asyncio
+import json
 import logging
+from concurrent.futures import Executor
 from datetime import datetime
-from typing import Iterator
+from typing import Optional, Callable, Iterable, List, Tuple, Any
 
 import pytz
 from attr import dataclass
 from mautrix.types import EventID, RoomID
-from sqlalchemy import (Column, String, Integer, DateTime, Table, MetaData,
-                        select, and_)
+from sqlalchemy import (Column, String, Integer, DateTime, Text, Table, MetaData, Index,
+                        select, and_, or_, inspect, bindparam, func, text)
 from sqlalchemy.engine.base import Engine
 
+from .metrics import Metrics
+
+
+# Runs the blocking SQLAlchemy calls on a dedicated executor, so slow queries don't stall the event loop.
+# Statements are built once and executed on an engine with a compiled cache, so they are only compiled once.
+class ExecutorDatabase:
+    db: Engine
+    executor: Optional[Executor]
+    metrics: Metrics
+
+    def __init__(self, db: Engine, executor: Optional[Executor] = None, metrics: Optional[Metrics] = None) -> None:
+        self.db = db.execution_options(compiled_cache={})
+        self.executor = executor
+        self.metrics = metrics or Metrics()
+
+    # stage names the query in the metrics, the helpers are shared by queries that have little in common
+    async def _run(self, stage: str, func: Callable, *args) -> Any:
+        with self.metrics.time(stage):
+            return await asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    # create_all() only adds indexes together with new tables, so tables from older versions are patched here
+    def _create_missing_indexes(self, table: Table) -> None:
+        existing = {index["name"] for index in inspect(self.db).get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=self.db)
+
+    # The same for nullable columns added to existing tables
+    def _create_missing_columns(self, table: Table) -> None:
+        existing = {column["name"] for column in inspect(self.db).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=self.db.dialect)
+                self.db.execute(text(f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"))
+
 
 @dataclass
 class LifetimeEnd:
@@ -16,14 +54,22 @@ class LifetimeEnd:
     end_date: datetime = None
     room_id: RoomID = None
     event_id: EventID = None
+    owner: Optional[str] = None
+    lease_until: Optional[datetime] = None
 
 
-class LifetimeDatabase:
+# Several plugin instances can share the database: a row is expired by whoever claimed it. A claim is a lease
+# that runs out, so rows claimed by an instance that went away are picked up by the others.
+class LifetimeDatabase(ExecutorDatabase):
     lifetime_ends: Table
-    db: Engine
+    on_insert: Optional[Callable[[LifetimeEnd], None]]
+    pending_inserts: List[Tuple[LifetimeEnd, asyncio.Future]]
 
-    def __init__(self, db: Engine) -> None:
-        self.db = db
+    def __init__(self, db: Engine, executor: Optional[Executor] = None,
+                 on_insert: Optional[Callable[[LifetimeEnd], None]] = None, metrics: Optional[Metrics] = None) -> None:
+        super().__init__(db, executor, metrics)
+        self.on_insert = on_insert
+        self.pending_inserts = []
 
         meta = MetaData()
         meta.bind = db
@@ -32,23 +78,427 @@ class LifetimeDatabase:
                                    Column("id", Integer, primary_key=True, autoincrement=True),
                                    Column("end_date", DateTime, nullable=False),
                                    Column("room_id", String(255), nullable=False),
-                                   Column("event_id", String(255), nullable=False))
+                                   Column("event_id", String(255), nullable=False),
+                                   Column("owner", String(255)),
+                                   Column("lease_until", DateTime),
+                                   Index("ix_lifetime_ends_end_date", "end_date"))
 
         meta.create_all()
+        self._create_missing_columns(self.lifetime_ends)
+        self._create_missing_indexes(self.lifetime_ends)
+
+        self.insert_stmt = self.lifetime_ends.insert()
+        self.select_all_stmt = select([self.lifetime_ends]).order_by(self.lifetime_ends.c.end_date)
+        self.select_older_stmt = self.select_all_stmt.where(self.lifetime_ends.c.end_date < bindparam("end_date"))
+        self.delete_ids_stmt = self.lifetime_ends.delete().where(
+            self.lifetime_ends.c.id.in_(bindparam("ids", expanding=True)))
+
+        table = self.lifetime_ends
+        # Due rows that nobody holds a lease on. Postgres skips rows another instance is claiming right now,
+        # SQLite runs the whole UPDATE under its database lock.
+        claimable = select([table.c.id]).where(and_(
+            table.c.end_date <= bindparam("now"),
+            or_(table.c.lease_until.is_(None), table.c.lease_until < bindparam("now"))
+        )).order_by(table.c.end_date).limit(bindparam("limit")).with_for_update(skip_locked=True)
+        self.claim_stmt = table.update().where(table.c.id.in_(claimable)).values(
+            owner=bindparam("claim_owner"), lease_until=bindparam("claim_until"))
+        self.supports_returning = db.dialect.name == "postgresql"
+        if self.supports_returning:
+            self.claim_stmt = self.claim_stmt.returning(table.c.id, table.c.end_date, table.c.room_id,
+                                                        table.c.event_id, table.c.owner, table.c.lease_until)
+        self.select_claimed_stmt = select([table]).where(and_(
+            table.c.owner == bindparam("claim_owner"), table.c.lease_until == bindparam("claim_until")))
+        self.defer_stmt = table.update().where(and_(
+            table.c.id == bindparam("row_id"), table.c.owner == bindparam("claim_owner"))).values(
+            lease_until=bindparam("claim_until"))
+        self.release_stmt = table.update().where(and_(
+            table.c.id.in_(bindparam("ids", expanding=True)), table.c.owner == bindparam("claim_owner"))).values(
+            owner=None, lease_until=None)
+
+    # Inserts made in the same loop iteration are collected and written in a single transaction
+    async def insert(self, lifetime_end: LifetimeEnd) -> None:
+        future = asyncio.get_event_loop().create_future()
+        self.pending_inserts.append((lifetime_end, future))
+        if len(self.pending_inserts) == 1:
+            asyncio.ensure_future(self._flush_inserts())
+        await future
+
+    async def insert_many(self, lifetime_ends: Iterable[LifetimeEnd]) -> None:
+        await asyncio.gather(*(self.insert(lifetime_end) for lifetime_end in lifetime_ends))
+
+    async def _flush_inserts(self) -> None:
+        # Let the other coroutines of this loop iteration add their rows first
+        await asyncio.sleep(0)
+        batch, self.pending_inserts = self.pending_inserts, []
+        lifetime_ends = [lifetime_end for lifetime_end, _ in batch]
+        try:
+            ids = await self._run("db_lifetime_insert", self._insert_rows, lifetime_ends)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (lifetime_end, future), row_id in zip(batch, ids):
+            lifetime_end.id = row_id
+            logging.getLogger("maubot").info(f"Inserted event {lifetime_end.event_id} into database.")
+            if self.on_insert:
+                self.on_insert(lifetime_end)
+            if not future.done():
+                future.set_result(None)
+
+    def _insert_rows(self, lifetime_ends: List[LifetimeEnd]) -> List[int]:
+        with self.db.begin() as conn:
+            return [conn.execute(self.insert_stmt, end_date=lifetime_end.end_date, room_id=lifetime_end.room_id,
+                                 event_id=lifetime_end.event_id).inserted_primary_key[0]
+                    for lifetime_end in lifetime_ends]
+
+    async def get_all(self) -> List[LifetimeEnd]:
+        return await self._run("db_lifetime_load", self._select, self.select_all_stmt, {})
+
+    async def get_older_than(self, end_date: datetime) -> List[LifetimeEnd]:
+        return await self._run("db_lifetime_older", self._select, self.select_older_stmt, {"end_date": end_date})
+
+    def _select(self, stmt, params: dict) -> List[LifetimeEnd]:
+        return [self._from_row(row) for row in self.db.execute(stmt, params)]
+
+    @staticmethod
+    def _from_row(row) -> LifetimeEnd:
+        return LifetimeEnd(id=row[0], end_date=row[1].replace(tzinfo=pytz.UTC), room_id=row[2], event_id=row[3],
+                           owner=row[4], lease_until=row[5].replace(tzinfo=pytz.UTC) if row[5] else None)
+
+    # Leases up to `limit` due rows to the owner until lease_until and returns them, oldest first
+    async def claim_due(self, owner: str, now: datetime, lease_until: datetime, limit: int) -> List[LifetimeEnd]:
+        return await self._run("db_claim", self._claim_due, owner, now, lease_until, limit)
+
+    def _claim_due(self, owner: str, now: datetime, lease_until: datetime, limit: int) -> List[LifetimeEnd]:
+        params = {"now": now, "limit": limit, "claim_owner": owner, "claim_until": lease_until}
+        with self.db.begin() as conn:
+            if self.supports_returning:
+                rows = conn.execute(self.claim_stmt, params).fetchall()
+            else:
+                conn.execute(self.claim_stmt, params)
+                rows = conn.execute(self.select_claimed_stmt, params).fetchall()
+        return sorted((self._from_row(row) for row in rows), key=lambda lifetime_end: lifetime_end.end_date)
+
+    # Keeps the lease until a retry is due, the row can be claimed again afterwards
+    async def defer(self, lifetime_end: LifetimeEnd, owner: str, until: datetime) -> None:
+        await self._run("db_defer", self._execute, self.defer_stmt,
+                        {"row_id": lifetime_end.id, "claim_owner": owner, "claim_until": until})
+
+    # Gives up the lease on rows that were claimed but not expired, e.g. on shutdown
+    async def release(self, ids: Iterable[int], owner: str) -> None:
+        ids = list(ids)
+        if ids:
+            await self._run("db_release", self._execute, self.release_stmt, {"ids": ids, "claim_owner": owner})
+
+    def _execute(self, stmt, params: dict) -> None:
+        self.db.execute(stmt, params)
+
+    async def remove(self, lifetime_end: LifetimeEnd) -> None:
+        await self.remove_ids([lifetime_end.id])
+
+    async def remove_ids(self, ids: Iterable[int]) -> None:
+        ids = list(ids)
+        if ids:
+            await self._run("db_lifetime_delete", self._delete_ids, ids)
+
+    def _delete_ids(self, ids: List[int]) -> None:
+        self.db.execute(self.delete_ids_stmt, ids=ids)
+
+
+@dataclass
+class IdentifierEvent:
+    id: int = None
+    room_id: RoomID = None
+    identifier: str = None
+    event_id: EventID = None
+
+
+# Only the newest events of each identifier are kept, older ones are pruned on insert
+class IdentifierDatabase(ExecutorDatabase):
+    identifier_events: Table
+    keep: int
+
+    def __init__(self, db: Engine, executor: Optional[Executor] = None, keep: int = 10,
+                 metrics: Optional[Metrics] = None) -> None:
+        super().__init__(db, executor, metrics)
+        self.keep = max(1, keep)
+
+        meta = MetaData()
+        meta.bind = db
+
+        self.identifier_events = Table("identifier_events", meta,
+                                       Column("id", Integer, primary_key=True, autoincrement=True),
+                                       Column("room_id", String(255), nullable=False),
+                                       Column("identifier", String(255), nullable=False),
+                                       Column("event_id", String(255), nullable=False),
+                                       Index("ix_identifier_events_room_identifier", "room_id", "identifier"),
+                                       Index("ix_identifier_events_event_id", "event_id"))
+
+        meta.create_all()
+
+        self.insert_stmt = self.identifier_events.insert()
+        # Most recently sent event for the identifier in the given room
+        self.select_latest_stmt = select([self.identifier_events]).where(and_(
+            self.identifier_events.c.room_id == bindparam("room_id"),
+            self.identifier_events.c.identifier == bindparam("identifier")
+        )).order_by(self.identifier_events.c.id.desc()).limit(1)
+        self.delete_event_stmt = self.identifier_events.delete().where(and_(
+            self.identifier_events.c.room_id == bindparam("room_id"),
+            self.identifier_events.c.event_id == bindparam("event_id")
+        ))
+        # Removes the events of an identifier that are older than its `offset + 1` newest ones
+        table = self.identifier_events
+        same_identifier = and_(table.c.room_id == bindparam("room_id"), table.c.identifier == bindparam("identifier"))
+        oldest_kept = select([table.c.id]).where(same_identifier).order_by(table.c.id.desc()).limit(1).offset(
+            bindparam("offset")).as_scalar()
+        self.prune_stmt = table.delete().where(and_(same_identifier, table.c.id < oldest_kept))
+        # Rooms ordered by the most recent message sent to them
+        self.select_recent_rooms_stmt = select([self.identifier_events.c.room_id]).group_by(
+            self.identifier_events.c.room_id).order_by(func.max(self.identifier_events.c.id).desc()).limit(
+            bindparam("limit"))
+
+    async def insert(self, identifier_event: IdentifierEvent) -> None:
+        logging.getLogger("maubot").debug(
+            f"Indexed event {identifier_event.event_id} for identifier {identifier_event.identifier}.")
+        await self._run("db_index_insert", self._insert, identifier_event)
+
+    def _insert(self, identifier_event: IdentifierEvent) -> None:
+        with self.db.begin() as conn:
+            conn.execute(self.insert_stmt, room_id=identifier_event.room_id,
+                         identifier=identifier_event.identifier, event_id=identifier_event.event_id)
+            conn.execute(self.prune_stmt, room_id=identifier_event.room_id,
+                         identifier=identifier_event.identifier, offset=self.keep - 1)
+
+    async def get_latest(self, room_id: RoomID, identifier: str) -> Optional[IdentifierEvent]:
+        row = await self._run("db_index_lookup", self._first, self.select_latest_stmt,
+                              {"room_id": room_id, "identifier": identifier})
+        if not row:
+            return None
+        return IdentifierEvent(id=row[0], room_id=row[1], identifier=row[2], event_id=row[3])
+
+    async def remove_event(self, room_id: RoomID, event_id: EventID) -> None:
+        await self._run("db_index_remove", self._execute, self.delete_event_stmt,
+                        {"room_id": room_id, "event_id": event_id})
+
+    async def get_recent_rooms(self, limit: int) -> List[RoomID]:
+        if limit <= 0:
+            return []
+        return await self._run("db_recent_rooms", self._get_recent_rooms, limit)
+
+    def _get_recent_rooms(self, limit: int) -> List[RoomID]:
+        return [RoomID(row[0]) for row in self.db.execute(self.select_recent_rooms_stmt, limit=limit)]
+
+    def _execute(self, stmt, params: dict) -> None:
+        self.db.execute(stmt, params)
+
+    def _first(self, stmt, params: dict):
+        return self.db.execute(stmt, params).first()
+
+
+@dataclass
+class CachedMedia:
+    content_hash: str = None
+    thumbnail_size: int = None
+    thumbnail_variant: str = None
+    file: dict = None
+    info: dict = None
+
+
+# Uploaded images by content hash and thumbnail size, so identical images are only uploaded once.
+# Least recently used entries are evicted once more than max_entries are stored. An entry only matches
+# thumbnails made with the same variant (format and quality), another variant replaces it.
+class MediaCacheDatabase(ExecutorDatabase):
+    media_cache: Table
+    max_entries: int
+
+    def __init__(self, db: Engine, executor: Optional[Executor] = None, max_entries: int = 1000,
+                 metrics: Optional[Metrics] = None) -> None:
+        super().__init__(db, executor, metrics)
+        self.max_entries = max_entries
+
+        meta = MetaData()
+        meta.bind = db
+
+        self.media_cache = Table("media_cache", meta,
+                                 Column("id", Integer, primary_key=True, autoincrement=True),
+                                 Column("content_hash", String(64), nullable=False),
+                                 Column("thumbnail_size", Integer, nullable=False),
+                                 Column("thumbnail_variant", String(32)),
+                                 Column("file", Text, nullable=False),
+                                 Column("info", Text, nullable=False),
+                                 Column("last_used", DateTime, nullable=False),
+                                 Index("ix_media_cache_key", "content_hash", "thumbnail_size", unique=True),
+                                 Index("ix_media_cache_last_used", "last_used"))
+
+        meta.create_all()
+        self._create_missing_columns(self.media_cache)
+
+        # Bind names differ from the column names, which update() reserves for its SET clause
+        key = and_(self.media_cache.c.content_hash == bindparam("key_content_hash"),
+                   self.media_cache.c.thumbnail_size == bindparam("key_thumbnail_size"))
+        self.select_stmt = select([self.media_cache.c.file, self.media_cache.c.info]).where(
+            and_(key, self.media_cache.c.thumbnail_variant == bindparam("thumbnail_variant")))
+        self.touch_stmt = self.media_cache.update().where(key).values(last_used=bindparam("last_used"))
+        self.delete_stmt = self.media_cache.delete().where(key)
+        self.insert_stmt = self.media_cache.insert()
+        self.count_stmt = select([func.count()]).select_from(self.media_cache)
+        self.oldest_stmt = select([self.media_cache.c.id]).order_by(self.media_cache.c.last_used).limit(
+            bindparam("limit"))
+        self.delete_ids_stmt = self.media_cache.delete().where(
+            self.media_cache.c.id.in_(bindparam("ids", expanding=True)))
+
+    async def get(self, content_hash: str, thumbnail_size: int, thumbnail_variant: str) -> Optional[CachedMedia]:
+        if self.max_entries <= 0:
+            return None
+        return await self._run("db_media_lookup", self._get, content_hash, thumbnail_size, thumbnail_variant)
+
+    def _get(self, content_hash: str, thumbnail_size: int, thumbnail_variant: str) -> Optional[CachedMedia]:
+        with self.db.begin() as conn:
+            row = conn.execute(self.select_stmt, key_content_hash=content_hash, key_thumbnail_size=thumbnail_size,
+                               thumbnail_variant=thumbnail_variant).first()
+            if not row:
+                return None
+            conn.execute(self.touch_stmt, key_content_hash=content_hash, key_thumbnail_size=thumbnail_size,
+                         last_used=datetime.now(tz=pytz.UTC))
+        return CachedMedia(content_hash=content_hash, thumbnail_size=thumbnail_size,
+                           thumbnail_variant=thumbnail_variant, file=json.loads(row[0]), info=json.loads(row[1]))
+
+    async def put(self, cached_media: CachedMedia) -> None:
+        if self.max_entries > 0:
+            await self._run("db_media_store", self._put, cached_media)
+
+    def _put(self, cached_media: CachedMedia) -> None:
+        with self.db.begin() as conn:
+            # Two identical images sent at the same time both miss, the later one wins
+            conn.execute(self.delete_stmt, key_content_hash=cached_media.content_hash,
+                         key_thumbnail_size=cached_media.thumbnail_size)
+            conn.execute(self.insert_stmt, content_hash=cached_media.content_hash,
+                         thumbnail_size=cached_media.thumbnail_size,
+                         thumbnail_variant=cached_media.thumbnail_variant, file=json.dumps(cached_media.file),
+                         info=json.dumps(cached_media.info), last_used=datetime.now(tz=pytz.UTC))
+            overflow = conn.execute(self.count_stmt).scalar() - self.max_entries
+            if overflow > 0:
+                ids = [row[0] for row in conn.execute(self.oldest_stmt, limit=overflow)]
+                conn.execute(self.delete_ids_stmt, ids=ids)
+
+
+@dataclass
+class SpooledCallback:
+    id: int = None
+    url: str = None
+    payload: dict = None
+    attempts: int = 0
+
+
+# Callbacks that were not delivered yet when the plugin stopped
+class CallbackSpoolDatabase(ExecutorDatabase):
+    callback_spool: Table
+
+    def __init__(self, db: Engine, executor: Optional[Executor] = None, metrics: Optional[Metrics] = None) -> None:
+        super().__init__(db, executor, metrics)
+
+        meta = MetaData()
+        meta.bind = db
+
+        self.callback_spool = Table("callback_spool", meta,
+                                    Column("id", Integer, primary_key=True, autoincrement=True),
+                                    Column("url", Text, nullable=False),
+                                    Column("payload", Text, nullable=False),
+                                    Column("attempts", Integer, nullable=False))
+
+        meta.create_all()
+
+        self.insert_stmt = self.callback_spool.insert()
+        self.select_stmt = select([self.callback_spool]).order_by(self.callback_spool.c.id)
+        self.delete_ids_stmt = self.callback_spool.delete().where(
+            self.callback_spool.c.id.in_(bindparam("ids", expanding=True)))
+
+    async def insert_many(self, callbacks: List[SpooledCallback]) -> None:
+        if callbacks:
+            await self._run("db_callback_spool", self._insert_many, callbacks)
+
+    def _insert_many(self, callbacks: List[SpooledCallback]) -> None:
+        self.db.execute(self.insert_stmt, [{"url": callback.url, "payload": json.dumps(callback.payload),
+                                            "attempts": callback.attempts} for callback in callbacks])
+
+    async def pop_all(self) -> List[SpooledCallback]:
+        return await self._run("db_callback_unspool", self._pop_all)
+
+    def _pop_all(self) -> List[SpooledCallback]:
+        with self.db.begin() as conn:
+            callbacks = [SpooledCallback(id=row[0], url=row[1], payload=json.loads(row[2]), attempts=row[3])
+                         for row in conn.execute(self.select_stmt)]
+            if callbacks:
+                conn.execute(self.delete_ids_stmt, ids=[callback.id for callback in callbacks])
+        return callbacks
+
+
+@dataclass
+class IdempotentResponse:
+    room_id: RoomID = None
+    key: str = None
+    status: int = None
+    body: str = None
+    content_type: Optional[str] = None
+    expires: datetime = None
+
+
+# Responses of pushes that carried an idempotency key, kept until they expire
+class IdempotencyDatabase(ExecutorDatabase):
+    idempotency_keys: Table
+
+    def __init__(self, db: Engine, executor: Optional[Executor] = None, metrics: Optional[Metrics] = None) -> None:
+        super().__init__(db, executor, metrics)
+
+        meta = MetaData()
+        meta.bind = db
+
+        self.idempotency_keys = Table("idempotency_keys", meta,
+                                      Column("id", Integer, primary_key=True, autoincrement=True),
+                                      Column("room_id", String(255), nullable=False),
+                                      Column("key", String(255), nullable=False),
+                                      Column("status", Integer, nullable=False),
+                                      Column("body", Text, nullable=False),
+                                      Column("content_type", String(255)),
+                                      Column("expires", DateTime, nullable=False),
+                                      Index("ix_idempotency_keys_key", "room_id", "key", unique=True),
+                                      Index("ix_idempotency_keys_expires", "expires"))
+
+        meta.create_all()
+
+        key = and_(self.idempotency_keys.c.room_id == bindparam("room_id"),
+                   self.idempotency_keys.c.key == bindparam("key"))
+        self.select_stmt = select([self.idempotency_keys.c.status, self.idempotency_keys.c.body,
+                                   self.idempotency_keys.c.content_type, self.idempotency_keys.c.expires]).where(
+            and_(key, self.idempotency_keys.c.expires > bindparam("now")))
+        self.delete_stmt = self.idempotency_keys.delete().where(key)
+        self.insert_stmt = self.idempotency_keys.insert()
+        self.delete_expired_stmt = self.idempotency_keys.delete().where(
+            self.idempotency_keys.c.expires <= bindparam("now"))
+
+    async def get(self, room_id: RoomID, key: str) -> Optional[IdempotentResponse]:
+        return await self._run("db_idempotency_lookup", self._get, room_id, key)
+
+    def _get(self, room_id: RoomID, key: str) -> Optional[IdempotentResponse]:
+        row = self.db.execute(self.select_stmt, room_id=room_id, key=key, now=datetime.now(tz=pytz.UTC)).first()
+        if not row:
+            return None
+        return IdempotentResponse(room_id=room_id, key=key, status=row[0], body=row[1], content_type=row[2],
+                                  expires=row[3].replace(tzinfo=pytz.UTC))
+
+    async def put(self, response: IdempotentResponse) -> None:
+        await self._run("db_idempotency_store", self._put, response)
+
+    def _put(self, response: IdempotentResponse) -> None:
+        with self.db.begin() as conn:
+            # An expired row for the same key may still be there
+            conn.execute(self.delete_stmt, room_id=response.room_id, key=response.key)
+            conn.execute(self.insert_stmt, room_id=response.room_id, key=response.key, status=response.status,
+                         body=response.body, content_type=response.content_type, expires=response.expires)
+
+    async def remove_expired(self) -> int:
+        return await self._run("db_idempotency_expire", self._remove_expired)
 
-    def insert(self, lifetime_end: LifetimeEnd) -> None:
-        logging.getLogger("maubot").info(f"Inserted event {lifetime_end.event_id} into database.")
-        self.db.execute(self.lifetime_ends.insert()
-                        .values(end_date=lifetime_end.end_date, room_id=lifetime_end.room_id,
-                                event_id=lifetime_end.event_id))
-
-    def get_older_than(self, end_date: datetime) -> Iterator[LifetimeEnd]:
-        where = [self.lifetime_ends.c.end_date < end_date]
-        rows = self.db.execute(select([self.lifetime_ends]).where(and_(*where)))
-        for row in rows:
-            yield LifetimeEnd(id=row[0], end_date=row[1].replace(tzinfo=pytz.UTC), room_id=row[2],
-                              event_id=row[3])
-
-    def remove(self, lifetime_end: LifetimeEnd) -> None:
-        self.db.execute(self.lifetime_ends.delete().where(
-            and_(self.lifetime_ends.c.event_id == lifetime_end.event_id)))
+    def _remove_expired(self) -> int:
+        return self.db.execute(self.delete_expired_stmt, now=datetime.now(tz=pytz.UTC)).rowcount
@@ -0,0 +1,114 @@
+import asyncio
+import json
+from logging import Logger
+from typing import Awaitable, Callable, List, Optional, Tuple, TypeVar
+
+from mautrix.client import Client
+from mautrix.errors import MatrixRequestError
+from mautrix.types import Event, EncryptedEvent, PaginationDirection, RoomID, SyncToken
+
+from .metrics import Metrics
+from .ratelimit import is_rate_limited
+
+T = TypeVar("T")
+
+
+# A sync limited to a single room and a single timeline event, for homeservers that require a token to paginate
+def room_sync_filter(room_id: RoomID) -> str:
+    return json.dumps({
+        "room": {"rooms": [room_id], "timeline": {"limit": 1}, "state": {"types": []},
+                 "ephemeral": {"types": []}, "account_data": {"types": []}},
+        "presence": {"types": []},
+        "account_data": {"types": []},
+    })
+
+
+# Walks the room history backwards page by page and returns the newest event sent by the bot that matches.
+# Pages are fetched one ahead while the current one is decrypted, and the walk stops at the first match.
+# Requests go through `send`, which paces them, retries them when the homeserver rate-limits us and times them
+# under the given stage.
+class HistorySearch:
+    client: Client
+    room_id: RoomID
+    depth: int
+    page_size: int
+    log: Logger
+    rp_type: Optional[object]
+    metrics: Metrics
+    send: Callable[[Callable[[], Awaitable[T]], str], Awaitable[T]]
+
+    def __init__(self, client: Client, room_id: RoomID, log: Logger, depth: int = 1100, page_size: int = 100,
+                 rp_type: Optional[object] = None, metrics: Optional[Metrics] = None,
+                 send: Optional[Callable[[Callable[[], Awaitable[T]], str], Awaitable[T]]] = None) -> None:
+        self.client = client
+        self.room_id = room_id
+        self.depth = depth
+        self.page_size = page_size
+        self.log = log
+        self.rp_type = rp_type
+        self.metrics = metrics or Metrics()
+        self.send = send or self.send_directly
+
+    async def send_directly(self, call: Callable[[], Awaitable[T]], stage: str) -> T:
+        with self.metrics.time(stage, self.rp_type):
+            return await call()
+
+    async def find(self, matches: Callable[[Event], bool]) -> Optional[Event]:
+        try:
+            page = await self.get_page(None)
+        except MatrixRequestError as e:
+            if is_rate_limited(e):
+                raise
+            # Paginating without a token needs a v1.3 homeserver, older ones get the token from a room sync
+            self.log.debug(f"Paginating {self.room_id} without a token failed ({e}), syncing the room instead")
+            sync_result = await self.send(lambda: self.client.sync(timeout=0, filter_id=room_sync_filter(self.room_id)),
+                                          "history_sync")
+            token = sync_result["rooms"]["join"][self.room_id]["timeline"]["prev_batch"]
+            page = await self.get_page(token)
+
+        seen = 0
+        while True:
+            events, token = page
+            seen += len(events)
+            next_page = None
+            if token and events and seen < self.depth:
+                next_page = asyncio.ensure_future(self.get_page(token))
+            try:
+                match = next((event for event in await self.decrypt_page(events) if matches(event)), None)
+            except BaseException:
+                if next_page:
+                    next_page.cancel()
+                raise
+            if match:
+                if next_page:
+                    next_page.cancel()
+                return match
+            if not next_page:
+                self.log.debug(f"No match in the last {seen} events of {self.room_id}")
+                return None
+            page = await next_page
+
+    async def get_page(self, token: Optional[SyncToken]) -> Tuple[List[Event], Optional[SyncToken]]:
+        result = await self.send(lambda: self.client.get_messages(
+            room_id=self.room_id, direction=PaginationDirection.BACKWARD, from_token=token,
+            limit=self.page_size), "history_paginate")
+        # The end token is missing or unchanged once the start of the room is reached
+        return result.events, result.end if result.end != token else None
+
+    # Events come newest first and keep that order. Events from others are dropped before decrypting.
+    async def decrypt_page(self, events: List[Event]) -> List[Event]:
+        events = [event for event in events if event.sender == self.client.mxid]
+        with self.metrics.time("history_decrypt", self.rp_type):
+            results = await asyncio.gather(*(self.decrypt(event) for event in events), return_exceptions=True)
+        decrypted = []
+        for event, result in zip(events, results):
+            if isinstance(result, Exception):
+                self.log.debug(f"Skipping {event.event_id} in history search, decrypting failed: {result}")
+            else:
+                decrypted.append(result)
+        return decrypted
+
+    async def decrypt(self, event: Event) -> Event:
+        if isinstance(event, EncryptedEvent):
+            return await self.client.crypto.decrypt_megolm_event(event)
+        return event
@@ -0,0 +1,118 @@
+import asyncio
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from logging import Logger
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+import pytz
+from aiohttp.web import Response
+from mautrix.types import RoomID
+
+from .db import IdempotencyDatabase, IdempotentResponse
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+MAX_KEY_LENGTH = 255
+PRUNE_INTERVAL = 3600
+
+
+class InvalidIdempotencyKey(ValueError):
+    pass
+
+
+# Remembers the response to each push that carried an idempotency key, so a retried push gets that response
+# again instead of being sent a second time. A retry that arrives while the first push is still running waits
+# for its result. Successful responses are kept in memory (most recently used) and in the database until the
+# ttl ends. Failed pushes aren't remembered, retrying them does the work again.
+class IdempotencyCache:
+    db: IdempotencyDatabase
+    ttl: int
+    max_entries: int
+    entries: "OrderedDict[Tuple[RoomID, str], IdempotentResponse]"
+    in_flight: Dict[Tuple[RoomID, str], asyncio.Future]
+    last_prune: float
+    log: Logger
+
+    def __init__(self, db: IdempotencyDatabase, log: Logger, ttl: int = 86400, max_entries: int = 1000) -> None:
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.last_prune = 0
+        self.log = log
+
+    async def run(self, room_id: RoomID, key: str, handler: Callable[[], Awaitable[Response]]) -> Response:
+        if len(key) > MAX_KEY_LENGTH:
+            raise InvalidIdempotencyKey(f"The idempotency key must not be longer than {MAX_KEY_LENGTH} characters")
+        cache_key = (room_id, key)
+        in_flight = self.in_flight.get(cache_key)
+        if in_flight:
+            self.log.debug(f"Push with idempotency key {key} for {room_id} is in flight, waiting for it")
+            # The first push must not be cancelled when a waiting retry goes away
+            return make_response(await asyncio.shield(in_flight), replayed=True)
+        cached = self.get_cached(cache_key)
+        if cached:
+            self.log.debug(f"Replaying response for idempotency key {key} in {room_id}")
+            return make_response(cached, replayed=True)
+
+        future = self.in_flight[cache_key] = asyncio.get_event_loop().create_future()
+        try:
+            stored = await self.db.get(room_id, key)
+            if stored:
+                self.remember(cache_key, stored)
+                future.set_result(stored)
+                return make_response(stored, replayed=True)
+
+            response = await handler()
+            result = IdempotentResponse(room_id=room_id, key=key, status=response.status,
+                                        body=response.text or "", content_type=response.content_type,
+                                        expires=datetime.now(tz=pytz.UTC) + timedelta(seconds=self.ttl))
+            if 200 <= response.status < 300:
+                self.remember(cache_key, result)
+                await self.db.put(result)
+                await self.prune()
+            future.set_result(result)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieved here, so the exception isn't reported as never retrieved when nobody waits for it
+            future.exception()
+            raise
+        finally:
+            del self.in_flight[cache_key]
+
+    def get_cached(self, cache_key: Tuple[RoomID, str]) -> Optional[IdempotentResponse]:
+        cached = self.entries.get(cache_key)
+        if not cached:
+            return None
+        if cached.expires <= datetime.now(tz=pytz.UTC):
+            del self.entries[cache_key]
+            return None
+        self.entries.move_to_end(cache_key)
+        return cached
+
+    def remember(self, cache_key: Tuple[RoomID, str], response: IdempotentResponse) -> None:
+        if self.max_entries <= 0:
+            return
+        self.entries[cache_key] = response
+        self.entries.move_to_end(cache_key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    async def prune(self) -> None:
+        if time.monotonic() - self.last_prune < PRUNE_INTERVAL:
+            return
+        self.last_prune = time.monotonic()
+        removed = await self.db.remove_expired()
+        if removed:
+            self.log.debug(f"Removed {removed} expired idempotency keys")
+
+
+def make_response(result: IdempotentResponse, replayed: bool = False) -> Response:
+    headers = {"Idempotent-Replayed": "true"} if replayed else None
+    return Response(status=result.status, body=result.body or None, content_type=result.content_type,
+                    headers=headers)
@@ -0,0 +1,139 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from enum import Enum
+from logging import Logger
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from attr import dataclass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStatus(Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+@dataclass
+class Job:
+    id: str
+    room_id: str
+    run: Callable[[], Awaitable[Any]]
+    status: JobStatus = JobStatus.QUEUED
+    result: Any = None
+    error: Optional[str] = None
+    created: float = 0
+    finished: Optional[float] = None
+
+
+# Work accepted with 202 is executed here: one FIFO queue and worker per room, so pushes to a room keep
+# their order while rooms are served in parallel. Workers exit once their queue is drained.
+class JobQueue:
+    queues: Dict[str, "asyncio.Queue[Job]"]
+    workers: Dict[str, asyncio.Task]
+    jobs: "OrderedDict[str, Job]"
+    pending: int
+    max_room_depth: int
+    max_pending: int
+    keep_finished: int
+    stopping: bool
+    log: Logger
+
+    def __init__(self, log: Logger, max_room_depth: int = 100, max_pending: int = 1000,
+                 keep_finished: int = 1000) -> None:
+        self.queues = {}
+        self.workers = {}
+        self.jobs = OrderedDict()
+        self.pending = 0
+        self.max_room_depth = max_room_depth
+        self.max_pending = max_pending
+        self.keep_finished = keep_finished
+        self.stopping = False
+        self.log = log
+
+    # count is the number of jobs about to be submitted, e.g. one for every room of a group
+    def is_full(self, room_id: str, count: int = 1) -> bool:
+        queue = self.queues.get(room_id)
+        return self.stopping or self.pending + count > self.max_pending or bool(queue and queue.qsize() >= self.max_room_depth)
+
+    def submit(self, room_id: str, run: Callable[[], Awaitable[Any]]) -> Job:
+        if self.is_full(room_id):
+            raise QueueFull()
+        queue = self.queues.get(room_id)
+        if not queue:
+            queue = self.queues[room_id] = asyncio.Queue()
+        job = Job(id=uuid.uuid4().hex, room_id=room_id, run=run, created=time.time())
+        self.jobs[job.id] = job
+        self.pending += 1
+        queue.put_nowait(job)
+        if room_id not in self.workers:
+            self.workers[room_id] = asyncio.ensure_future(self.worker(room_id, queue))
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self.jobs.get(job_id)
+
+    async def worker(self, room_id: str, queue: "asyncio.Queue[Job]") -> None:
+        try:
+            while not queue.empty():
+                job = queue.get_nowait()
+                job.status = JobStatus.RUNNING
+                try:
+                    job.result = await job.run()
+                except asyncio.CancelledError:
+                    self.finish(job, JobStatus.FAILED, "Stopped while running")
+                    raise
+                except Exception as e:
+                    self.log.exception(f"Job {job.id} for room {room_id} failed")
+                    self.finish(job, JobStatus.FAILED, str(e) or type(e).__name__)
+                else:
+                    self.finish(job, JobStatus.DONE)
+        finally:
+            del self.workers[room_id]
+            if queue.empty():
+                del self.queues[room_id]
+
+    def finish(self, job: Job, status: JobStatus, error: Optional[str] = None) -> None:
+        job.status = status
+        job.error = error
+        job.finished = time.time()
+        job.run = None
+        self.pending -= 1
+        self.prune()
+
+    # Forget the oldest finished jobs, their results can't be queried anymore
+    def prune(self) -> None:
+        finished = len(self.jobs) - self.pending
+        for job_id in list(self.jobs):
+            if finished <= self.keep_finished:
+                return
+            if self.jobs[job_id].finished:
+                del self.jobs[job_id]
+                finished -= 1
+
+    # New pushes are rejected while the queued ones get `timeout` seconds to finish. Jobs still running after
+    # that are cancelled, and the ones that never ran are marked as failed, so they don't vanish silently.
+    async def stop(self, timeout: float = 10) -> None:
+        self.stopping = True
+        if self.workers:
+            await asyncio.wait(list(self.workers.values()), timeout=timeout)
+        cancelled = list(self.workers.values())
+        for worker in cancelled:
+            worker.cancel()
+        if cancelled:
+            await asyncio.wait(cancelled)
+        dropped = 0
+        for queue in self.queues.values():
+            while not queue.empty():
+                self.finish(queue.get_nowait(), JobStatus.FAILED, "Stopped before it ran")
+                dropped += 1
+        self.queues.clear()
+        if cancelled or dropped:
+            self.log.warning(f"Stopped with {len(cancelled)} running and {dropped} queued pushes that were "
+                             "accepted but not sent")
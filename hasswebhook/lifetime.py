@@ -0,0 +1,256 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, timedelta
+from logging import Logger
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+import pytz
+from attr import dataclass, asdict
+
+from .db import LifetimeDatabase, LifetimeEnd
+from .ratelimit import is_rate_limited, get_backoff
+
+
+@dataclass
+class LifetimeStats:
+    pending: int = 0
+    queued: int = 0
+    in_flight: int = 0
+    expired: int = 0
+    failed: int = 0
+    retries: int = 0
+    rate_limited: int = 0
+    claimed: int = 0
+    leases_lost: int = 0
+    catching_up: bool = False
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+# Keeps upcoming lifetime ends in a min-heap and sleeps exactly until the next one is due.
+# Due entries are redacted by a fixed number of workers. Rows are only deleted (in batches, by id)
+# once the redaction went through, so nothing is lost when the homeserver rate-limits us.
+# When several instances share the database, due rows are leased from it before they are redacted, so each row
+# is redacted by one instance only. The database is also polled, which picks up rows whose lease ran out because
+# the instance that claimed them went away.
+class LifetimeScheduler:
+    heap: List[Tuple[datetime, int, LifetimeEnd]]
+    queue: "asyncio.Queue[LifetimeEnd]"
+    wakeup: asyncio.Event
+    on_expire: Callable[[LifetimeEnd], Awaitable[bool]]
+    log: Logger
+    db: LifetimeDatabase
+    concurrency: int
+    delete_batch_size: int
+    max_attempts: int
+    attempts: Dict[int, int]
+    owner: str
+    lease_seconds: int
+    claim_batch_size: int
+    poll_interval: int
+    claimed: Dict[int, LifetimeEnd]
+    done_ids: List[int]
+    paused_until: float
+    rate_limit_attempts: int
+    stats: LifetimeStats
+
+    def __init__(self, on_expire: Callable[[LifetimeEnd], Awaitable[bool]], log: Logger, concurrency: int = 4,
+                 delete_batch_size: int = 50, max_attempts: int = 5, owner: str = "hasswebhook",
+                 lease_seconds: int = 300, claim_batch_size: int = 100, poll_interval: int = 60) -> None:
+        self.heap = []
+        self.queue = asyncio.Queue()
+        self.wakeup = asyncio.Event()
+        self.on_expire = on_expire
+        self.log = log
+        self.concurrency = max(1, concurrency)
+        self.delete_batch_size = max(1, delete_batch_size)
+        self.max_attempts = max(1, max_attempts)
+        self.attempts = {}
+        self.owner = owner
+        self.lease_seconds = max(1, lease_seconds)
+        self.claim_batch_size = max(1, claim_batch_size)
+        self.poll_interval = max(1, poll_interval)
+        self.claimed = {}
+        self.done_ids = []
+        self.paused_until = 0
+        self.rate_limit_attempts = 0
+        self.stats = LifetimeStats()
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def get_stats(self) -> LifetimeStats:
+        self.stats.pending = len(self.heap)
+        self.stats.queued = self.queue.qsize()
+        return self.stats
+
+    async def load(self, db: LifetimeDatabase) -> None:
+        self.db = db
+        for lifetime_end in await db.get_all():
+            heapq.heappush(self.heap, (lifetime_end.end_date, lifetime_end.id, lifetime_end))
+        overdue = sum(1 for end_date, _, _ in self.heap if end_date <= datetime.now(tz=pytz.UTC))
+        self.log.debug(f"Loaded {len(self.heap)} pending lifetime ends, {overdue} of them overdue")
+        if overdue:
+            self.stats.catching_up = True
+            self.log.info(f"Catching up on {overdue} expired lifetime ends")
+        self.wakeup.set()
+
+    def push(self, lifetime_end: LifetimeEnd) -> None:
+        self.schedule(lifetime_end.end_date, lifetime_end)
+
+    def schedule(self, when: datetime, lifetime_end: LifetimeEnd) -> None:
+        heapq.heappush(self.heap, (when, lifetime_end.id, lifetime_end))
+        # Only the earliest deadline decides how long the loop sleeps
+        if self.heap[0][2] is lifetime_end:
+            self.wakeup.set()
+
+    def pop_due(self, now: datetime) -> List[LifetimeEnd]:
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due.append(heapq.heappop(self.heap)[2])
+        return due
+
+    async def run(self) -> None:
+        workers = [asyncio.create_task(self.worker()) for _ in range(self.concurrency)]
+        try:
+            self.log.debug(f"Lifetime scheduler started as {self.owner}")
+            while True:
+                self.wakeup.clear()
+                now = datetime.now(tz=pytz.UTC)
+                # The heap only tells when to look, the claim decides which rows this instance redacts
+                self.pop_due(now)
+                # Rows are claimed only as fast as the workers get through them, so leases don't run out in the queue
+                if self.queue.qsize() < self.claim_batch_size and await self.claim(now) >= self.claim_batch_size:
+                    continue
+                delay = self.poll_interval
+                if self.heap:
+                    delay = min(delay, (self.heap[0][0] - now).total_seconds())
+                if delay > 0:
+                    await self.wait_for_wakeup(delay)
+        except asyncio.CancelledError:
+            self.log.debug("Lifetime scheduler stopped")
+        except Exception:
+            self.log.exception("Exception in lifetime scheduler")
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await self.flush_done()
+            # Rows claimed but not redacted yet can be taken over by another instance right away
+            await self.db.release(self.claimed.keys(), self.owner)
+            self.claimed.clear()
+
+    # Unlike wait_for, asyncio.wait never swallows a cancellation that arrives just as the wakeup is set,
+    # which would keep the loop running after stop()
+    async def wait_for_wakeup(self, timeout: float) -> None:
+        waiter = asyncio.ensure_future(self.wakeup.wait())
+        try:
+            await asyncio.wait([waiter], timeout=timeout)
+        finally:
+            waiter.cancel()
+
+    async def claim(self, now: datetime) -> int:
+        claimed = await self.db.claim_due(self.owner, now, now + timedelta(seconds=self.lease_seconds),
+                                          self.claim_batch_size)
+        for lifetime_end in claimed:
+            queued = self.claimed.get(lifetime_end.id)
+            if queued:
+                # Already queued here, its lease ran out while it waited and was renewed by this claim
+                queued.lease_until = lifetime_end.lease_until
+                continue
+            self.claimed[lifetime_end.id] = lifetime_end
+            self.queue.put_nowait(lifetime_end)
+        self.stats.claimed += len(claimed)
+        return len(claimed)
+
+    async def worker(self) -> None:
+        while True:
+            lifetime_end = await self.queue.get()
+            try:
+                await self.expire(lifetime_end)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                self.log.exception(f"Exception while expiring event {lifetime_end.event_id}")
+            finally:
+                self.queue.task_done()
+            if self.queue.empty() and self.stats.in_flight == 0:
+                await self.flush_done()
+                # More due rows may be waiting to be claimed
+                self.wakeup.set()
+                if self.stats.catching_up:
+                    self.stats.catching_up = False
+                    self.log.info(f"Caught up on expired lifetime ends: {self.stats.as_dict()}")
+
+    async def expire(self, lifetime_end: LifetimeEnd) -> None:
+        pause = self.paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+        if lifetime_end.lease_until and lifetime_end.lease_until <= datetime.now(tz=pytz.UTC):
+            # Another instance may have claimed the row by now, it is claimed again if nobody did
+            self.stats.leases_lost += 1
+            self.log.debug(f"Lease on lifetime end of {lifetime_end.event_id} ran out before it was redacted")
+            self.claimed.pop(lifetime_end.id, None)
+            self.wakeup.set()
+            return
+
+        attempt = self.attempts.get(lifetime_end.id, 0) + 1
+        error = None
+        self.stats.in_flight += 1
+        try:
+            success = await self.on_expire(lifetime_end)
+        except Exception as e:
+            success, error = None, e
+        finally:
+            self.stats.in_flight -= 1
+
+        if success is not None:
+            self.rate_limit_attempts = 0
+            # A False result means the event can't be redacted anymore (e.g. the bot left the room)
+            if success:
+                self.stats.expired += 1
+            else:
+                self.stats.failed += 1
+                self.log.warning(f"Could not redact event {lifetime_end.event_id}, dropping its lifetime end")
+            await self.mark_done(lifetime_end)
+        elif is_rate_limited(error):
+            self.stats.rate_limited += 1
+            # Rate limits don't count towards max_attempts, but back off further each time until a redaction
+            # goes through again. Workers that were already in flight when the pause started don't add to it.
+            now = time.monotonic()
+            if now >= self.paused_until:
+                self.rate_limit_attempts += 1
+            retry_after = get_backoff(self.rate_limit_attempts)
+            # Every worker waits, not just this one, so a rate limit doesn't turn into a storm of retries
+            self.paused_until = max(self.paused_until, now + retry_after)
+            self.log.debug(f"Rate limited while expiring {lifetime_end.event_id}, pausing for {retry_after}s")
+            self.stats.retries += 1
+            self.queue.put_nowait(lifetime_end)
+        elif attempt >= self.max_attempts:
+            self.stats.failed += 1
+            self.log.error(f"Giving up on expiring event {lifetime_end.event_id} after {attempt} attempts: {error}")
+            await self.mark_done(lifetime_end)
+        else:
+            self.attempts[lifetime_end.id] = attempt
+            self.stats.retries += 1
+            self.log.warning(f"Failed to expire event {lifetime_end.event_id} (attempt {attempt}): {error}")
+            retry_at = datetime.now(tz=pytz.UTC) + timedelta(seconds=get_backoff(attempt))
+            # The lease is held until the retry is due, then the row is claimed again
+            await self.db.defer(lifetime_end, self.owner, retry_at)
+            self.claimed.pop(lifetime_end.id, None)
+            self.schedule(retry_at, lifetime_end)
+
+    async def mark_done(self, lifetime_end: LifetimeEnd) -> None:
+        self.attempts.pop(lifetime_end.id, None)
+        self.done_ids.append(lifetime_end.id)
+        if len(self.done_ids) >= self.delete_batch_size:
+            await self.flush_done()
+
+    async def flush_done(self) -> None:
+        if not self.done_ids:
+            return
+        ids, self.done_ids = self.done_ids, []
+        await self.db.remove_ids(ids)
+        for lifetime_end_id in ids:
+            self.claimed.pop(lifetime_end_id, None)
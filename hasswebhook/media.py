@@ -0,0 +1,110 @@
+import hashlib
+import time
+from base64 import b64decode
+from io import BytesIO
+from typing import Union, Tuple, Dict, Optional
+
+from PIL import Image as pil_image
+import attr
+from attr import dataclass
+from mautrix.crypto.attachments import encrypt_attachment
+from mautrix.types import EncryptedFile
+
+
+# Output formats for thumbnails and their mimetype
+THUMBNAIL_FORMATS = {"jpeg": "image/jpeg", "webp": "image/webp", "png": "image/png"}
+
+
+# Thumbnails depend on the output settings too, cached uploads made with other settings aren't reused
+def get_thumbnail_variant(thumbnail_format: str, thumbnail_quality: int) -> str:
+    return f"{thumbnail_format}:{thumbnail_quality}"
+
+
+@dataclass
+class ProcessedImage:
+    data: bytes
+    file: EncryptedFile
+    width: int
+    height: int
+    mimetype: Optional[str]  # detected from the image header
+    # None when the image is small enough to be its own thumbnail
+    thumbnail_data: Optional[bytes]
+    thumbnail_file: Optional[EncryptedFile]
+    thumbnail_width: int
+    thumbnail_height: int
+    thumbnail_mimetype: str = "image/png"
+    timings: Dict[str, float] = attr.ib(factory=dict)
+
+
+@dataclass
+class Thumbnail:
+    data: bytes
+    width: int
+    height: int
+    mimetype: str
+
+
+# Raw image bytes and their SHA-256, which is the key of the media cache.
+# Runs in a thread, handing the bytes to a process pool and back just to hash them would copy them twice more.
+def decode_image(content: Union[str, bytes, bytearray]) -> Tuple[Union[bytes, bytearray], str]:
+    data = b64decode(content) if isinstance(content, str) else content
+    return data, hashlib.sha256(data).hexdigest()
+
+
+# The CPU-bound part of sending an image: decode, thumbnail and encrypt.
+# Kept free of plugin state so it can run in a thread or process pool, where it is the only job per image.
+def process_image(content: Union[str, bytes, bytearray], thumbnail_size: int, thumbnail_format: str = "jpeg",
+                  thumbnail_quality: int = 80) -> ProcessedImage:
+    bytes_image = b64decode(content) if isinstance(content, str) else content
+
+    start = time.perf_counter()
+    with pil_image.open(BytesIO(bytes_image)) as img:
+        # Opening only reads the header, the pixels aren't decoded unless a thumbnail is needed
+        width, height = img.size
+        mimetype = img.get_format_mimetype()
+        thumbnail = None
+        if max(width, height) > thumbnail_size:
+            thumbnail = make_thumbnail(img, thumbnail_size, thumbnail_format, thumbnail_quality)
+    thumbnail_done = time.perf_counter()
+
+    # Uploads arrive as bytearray, which encrypt_attachment only accepts as one chunk of an iterable
+    encrypted_image, file = encrypt_attachment([bytes_image])
+    if thumbnail is None:
+        return ProcessedImage(data=encrypted_image, file=file, width=width, height=height, mimetype=mimetype,
+                              thumbnail_data=None, thumbnail_file=None,
+                              thumbnail_width=width, thumbnail_height=height, thumbnail_mimetype=mimetype,
+                              timings={"thumbnail": thumbnail_done - start,
+                                       "encrypt": time.perf_counter() - thumbnail_done})
+    enc_tn, tn_file = encrypt_attachment(thumbnail.data)
+    return ProcessedImage(data=encrypted_image, file=file, width=width, height=height, mimetype=mimetype,
+                          thumbnail_data=enc_tn, thumbnail_file=tn_file,
+                          thumbnail_width=thumbnail.width, thumbnail_height=thumbnail.height,
+                          thumbnail_mimetype=thumbnail.mimetype,
+                          timings={"thumbnail": thumbnail_done - start,
+                                   "encrypt": time.perf_counter() - thumbnail_done})
+
+
+# JPEGs are decoded at a reduced scale (1/2 to 1/8) that is still at least the thumbnail size, which is much
+# faster than decoding the full image. Images with transparency are saved as PNG when JPEG output is chosen.
+def make_thumbnail(img: pil_image.Image, thumbnail_size: int, thumbnail_format: str = "jpeg",
+                   quality: int = 80) -> Thumbnail:
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        thumbnail_format = "jpeg"
+    has_alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    if thumbnail_format == "jpeg" and has_alpha:
+        thumbnail_format = "png"
+
+    img.draft("RGB", (thumbnail_size, thumbnail_size))
+    img.thumbnail((thumbnail_size, thumbnail_size), pil_image.LANCZOS)
+    if thumbnail_format == "jpeg":
+        img = img.convert("RGB")
+    elif img.mode not in ("RGB", "RGBA", "L", "LA"):
+        img = img.convert("RGBA" if has_alpha else "RGB")
+
+    output = BytesIO()
+    if thumbnail_format == "png":
+        img.save(output, format="PNG", optimize=False)
+    else:
+        img.save(output, format=thumbnail_format.upper(), quality=quality)
+    return Thumbnail(data=output.getvalue(), width=img.width, height=img.height,
+                     mimetype=THUMBNAIL_FORMATS[thumbnail_format])
@@ -0,0 +1,176 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+LabelValues = Tuple[Tuple[str, str], ...]
+
+
+def escape_label(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: LabelValues, extra: Optional[Tuple[str, str]] = None) -> str:
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in items) + "}"
+
+
+# Minimal Prometheus metric types, rendered in the text exposition format.
+# Database calls and image processing observe from worker threads, hence the lock.
+class Metric:
+    name: str
+    help: str
+    type: str = "untyped"
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+        self.lock = threading.Lock()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"] + self.render_samples()
+
+    def render_samples(self) -> List[str]:
+        raise NotImplementedError()
+
+
+class Counter(Metric):
+    type = "counter"
+    values: Dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render_samples(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{format_labels(labels)} {value}" for labels, value in self.values.items()]
+
+
+class Gauge(Metric):
+    type = "gauge"
+    values: Dict[LabelValues, float]
+    functions: Dict[LabelValues, Callable[[], float]]
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values = {}
+        self.functions = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    # The value is read from the function whenever the metrics are scraped
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        self.functions[tuple(sorted(labels.items()))] = function
+
+    def render_samples(self) -> List[str]:
+        with self.lock:
+            values = dict(self.values)
+        for labels, function in self.functions.items():
+            values[labels] = function()
+        return [f"{self.name}{format_labels(labels)} {value}" for labels, value in values.items()]
+
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: Tuple[float, ...]
+    counts: Dict[LabelValues, List[int]]
+    sums: Dict[LabelValues, float]
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counts = self.counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1
+            self.sums[key] = self.sums.get(key, 0) + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render_samples(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for labels, counts in self.counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_labels(labels, ('le', str(bound)))} {count}")
+                lines.append(f"{self.name}_bucket{format_labels(labels, ('le', '+Inf'))} {counts[-1]}")
+                lines.append(f"{self.name}_sum{format_labels(labels)} {self.sums[labels]}")
+                lines.append(f"{self.name}_count{format_labels(labels)} {counts[-1]}")
+        return lines
+
+
+# One registry per plugin instance, so several instances in one maubot process each report their own numbers
+class Metrics:
+    request_seconds: Histogram
+    stage_seconds: Histogram
+    failures: Counter
+    rate_limited: Counter
+    in_flight: Gauge
+    lifetime_backlog: Gauge
+
+    def __init__(self) -> None:
+        self.request_seconds = Histogram("hasswebhook_request_seconds",
+                                         "Time to handle a push, by RoomPosterType")
+        self.stage_seconds = Histogram("hasswebhook_stage_seconds",
+                                       "Time spent in each stage of handling a push, by stage and RoomPosterType")
+        self.failures = Counter("hasswebhook_failures_total", "Pushes (by RoomPosterType) and callbacks that failed")
+        self.rate_limited = Counter("hasswebhook_rate_limited_total",
+                                    "Pushes the homeserver answered with M_LIMIT_EXCEEDED, by RoomPosterType")
+        self.in_flight = Gauge("hasswebhook_requests_in_flight", "Push requests currently being handled")
+        self.lifetime_backlog = Gauge("hasswebhook_lifetime_backlog", "Lifetime ends waiting to be expired")
+
+    # Usage: with metrics.time("upload", rp_type): ...
+    def time(self, stage: str, rp_type: Optional[object] = None):
+        return self.stage_seconds.time(stage=stage, type=type_label(rp_type))
+
+    def observe(self, stage: str, seconds: float, rp_type: Optional[object] = None) -> None:
+        self.stage_seconds.observe(seconds, stage=stage, type=type_label(rp_type))
+
+    @contextmanager
+    def track_in_flight(self) -> Iterator[None]:
+        self.in_flight.inc()
+        try:
+            yield
+        finally:
+            self.in_flight.dec()
+
+    def render(self) -> str:
+        lines = []
+        for metric in (self.request_seconds, self.stage_seconds, self.failures, self.rate_limited, self.in_flight,
+                       self.lifetime_backlog):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def type_label(rp_type: Optional[object]) -> str:
+    return getattr(rp_type, "name", "none").lower()
+
@@ -0,0 +1,167 @@
+import json
+import logging
+import random
+from logging import Logger
+from typing import Any, Optional, Union
+
+import attr
+from attr import dataclass
+
+from .ratelimit import Priority
+from .roomposter import RoomPosterType
+
+
+class InvalidPush(ValueError):
+    pass
+
+
+LIFETIME_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+
+# Lifetimes are given in minutes, or with a unit suffix ("30s", "5m", "2h", "1d"). Returns seconds or -1 if unset.
+def parse_lifetime(lifetime: Union[str, int, float, None]) -> int:
+    if lifetime is None or lifetime == "":
+        return -1
+    unit = 60
+    if isinstance(lifetime, str):
+        lifetime = lifetime.strip().lower()
+        if lifetime and lifetime[-1] in LIFETIME_UNITS:
+            unit = LIFETIME_UNITS[lifetime[-1]]
+            lifetime = lifetime[:-1]
+    try:
+        seconds = int(float(lifetime) * unit)
+    except (TypeError, ValueError):
+        raise InvalidPush(f"Invalid lifetime '{lifetime}', use minutes or a number with s, m, h or d")
+    return seconds if seconds >= 0 else -1
+
+
+# Pushes can set their priority ("high", "normal" or "low"), otherwise it follows from their type
+def parse_priority(priority: Optional[str]) -> Optional[Priority]:
+    if priority is None or priority == "":
+        return None
+    parsed = Priority.get_priority_from_str(priority)
+    if parsed is None:
+        raise InvalidPush(f"Unknown priority '{priority}', use high, normal or low")
+    return parsed
+
+
+def parse_bool(value: Any) -> Optional[bool]:
+    if value is None:
+        return None
+    return str(value).lower() in ("1", "true", "yes")
+
+
+def get_str(req_dict: dict, key: str, default: Optional[str] = None) -> Optional[str]:
+    value = req_dict.get(key, default)
+    if value is not None and not isinstance(value, str):
+        if isinstance(value, (dict, list)):
+            raise InvalidPush(f"'{key}' must be a string")
+        value = str(value)
+    return value
+
+
+# A push as sent to the webhook, validated once after the body is parsed
+@dataclass
+class PushRequest:
+    rp_type: RoomPosterType
+    message: Optional[str] = None
+    identifier: str = ""
+    callback_url: str = ""
+    lifetime: int = -1  # seconds
+    priority: Optional[Priority] = None
+    idempotency_key: Optional[str] = None
+    run_async: Optional[bool] = None
+    # Image parameters, content is base64 from JSON pushes and raw bytes from uploads
+    content: Union[str, bytes, bytearray, None] = attr.ib(default=None, repr=False)
+    content_type: Optional[str] = None
+    name: Optional[str] = None
+    thumbnail_size: int = 128
+
+    # Uploads pass the image separately, their other parameters come from the query string or form fields
+    @classmethod
+    def parse(cls, req_dict: Any, message_key: str = "message",
+              content: Union[bytes, bytearray, None] = None) -> "PushRequest":
+        if not isinstance(req_dict, dict):
+            raise InvalidPush("Please pass a JSON object")
+        mtype = get_str(req_dict, "type", "message")
+        rp_type = RoomPosterType.get_type_from_str(mtype)
+        if rp_type is None:
+            raise InvalidPush(f"Unknown type '{mtype}', use message, edit, reaction, redaction or image")
+        try:
+            thumbnail_size = int(req_dict.get("thumbnailSize", 128))
+        except (TypeError, ValueError):
+            raise InvalidPush("'thumbnailSize' must be a number")
+        if thumbnail_size < 1:
+            raise InvalidPush("'thumbnailSize' must be at least 1")
+
+        push = cls(
+            rp_type=rp_type,
+            message=get_str(req_dict, message_key),
+            identifier=get_str(req_dict, "identifier") or "",
+            callback_url=get_str(req_dict, "callback_url") or "",
+            lifetime=parse_lifetime(req_dict.get("lifetime", "")),
+            priority=parse_priority(get_str(req_dict, "priority")),
+            idempotency_key=get_str(req_dict, "idempotency_key"),
+            run_async=parse_bool(req_dict.get("async")),
+            content=content if content is not None else get_str(req_dict, "content"),
+            content_type=get_str(req_dict, "contentType"),
+            name=get_str(req_dict, "name"),
+            thumbnail_size=thumbnail_size,
+        )
+        if push.rp_type == RoomPosterType.IMAGE and not push.content:
+            raise InvalidPush("Type is set to image. Please pass at least the 'content' property (base64 image)")
+        if push.content:
+            push.rp_type = RoomPosterType.IMAGE
+        return push
+
+    # For logs: the message is shortened and image content is replaced by its size
+    def summary(self, max_length: int = 200) -> str:
+        fields = {"type": self.rp_type.name.lower()}
+        if self.message is not None:
+            fields["message"] = truncate(self.message, max_length)
+        for key in ("identifier", "callback_url", "content_type", "name"):
+            value = getattr(self, key)
+            if value:
+                fields[key] = truncate(value, max_length)
+        if self.lifetime != -1:
+            fields["lifetime"] = self.lifetime
+        if self.priority is not None:
+            fields["priority"] = self.priority.name.lower()
+        if self.content:
+            fields["content"] = f"<{len(self.content)} bytes>"
+        return json.dumps(fields, ensure_ascii=False)
+
+
+def truncate(value: str, max_length: int) -> str:
+    return value if len(value) <= max_length else f"{value[:max_length]}… ({len(value)} chars)"
+
+
+# Formats its arguments only when the record is actually emitted
+class LazySummary:
+    def __init__(self, push: PushRequest, max_length: int) -> None:
+        self.push = push
+        self.max_length = max_length
+
+    def __str__(self) -> str:
+        return self.push.summary(self.max_length)
+
+
+# Logs one in every 1/sample_rate pushes at INFO, and every push at DEBUG if that level is enabled
+class PushLog:
+    log: Logger
+    sample_rate: float
+    max_length: int
+
+    def __init__(self, log: Logger, sample_rate: float = 1.0, max_length: int = 200) -> None:
+        self.log = log
+        self.sample_rate = sample_rate
+        self.max_length = max_length
+
+    def push(self, room_id: str, push: PushRequest) -> None:
+        if self.log.isEnabledFor(logging.DEBUG):
+            level = logging.DEBUG
+        elif self.sample_rate >= 1 or random.random() < self.sample_rate:
+            level = logging.INFO
+        else:
+            return
+        self.log.log(level, "Push for room %s: %s", room_id, LazySummary(push, self.max_length))
@@ -0,0 +1,147 @@
+import asyncio
+import heapq
+import itertools
+import time
+from enum import IntEnum
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from mautrix.errors import MLimitExceeded
+
+
+def is_rate_limited(error: Exception) -> bool:
+    return isinstance(error, MLimitExceeded) or getattr(error, "http_status", None) == 429
+
+
+# Seconds to wait before retrying, doubling with each attempt.
+# mautrix drops the body of error responses, so the homeserver's retry_after_ms is never available to honour.
+def get_backoff(attempt: int, base: float = 1.0, cap: float = 60.0) -> float:
+    return min(cap, base * 2 ** max(0, attempt - 1))
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+    @classmethod
+    def get_priority_from_str(cls, priority: str) -> Optional["Priority"]:
+        return cls.__members__.get(str(priority).upper())
+
+
+class TokenBucket:
+    rate: float
+    burst: float
+    tokens: float
+    updated: float
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until a token is available, 0 if there is one now
+    def wait_time(self, now: float) -> float:
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self) -> None:
+        self.tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        self.refill(now)
+        return self.tokens >= self.burst
+
+
+# Paces sends to the homeserver with a global and a per-room token bucket. Waiting sends are let through by
+# priority, oldest first within a priority, but a send whose room has no budget left doesn't hold up other rooms.
+class RateLimiter:
+    room_rate: float
+    room_burst: float
+    global_bucket: Optional[TokenBucket]
+    room_buckets: Dict[str, TokenBucket]
+    waiters: List[Tuple[Priority, int, str, asyncio.Future]]
+    paused_until: float
+    timer: Optional[asyncio.TimerHandle]
+    counter: Iterator[int]
+
+    def __init__(self, rate: float = 0, burst: float = 1, room_rate: float = 0, room_burst: float = 1) -> None:
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.global_bucket = TokenBucket(rate, burst) if rate > 0 else None
+        self.room_buckets = {}
+        self.waiters = []
+        self.paused_until = 0
+        self.timer = None
+        self.counter = itertools.count()
+
+    async def acquire(self, room_id: str, priority: Priority = Priority.NORMAL) -> None:
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), room_id, future))
+        self.grant()
+        await future
+
+    # Nothing is sent until the backoff has passed
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def get_room_bucket(self, room_id: str) -> Optional[TokenBucket]:
+        if self.room_rate <= 0:
+            return None
+        bucket = self.room_buckets.get(room_id)
+        if not bucket:
+            bucket = self.room_buckets[room_id] = TokenBucket(self.room_rate, self.room_burst)
+        return bucket
+
+    def grant(self) -> None:
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        now = time.monotonic()
+        next_try = self.paused_until - now
+        if next_try <= 0:
+            next_try = None
+            waiting = []
+            for waiter in sorted(self.waiters):
+                future = waiter[3]
+                if future.done():
+                    continue
+                global_wait = self.global_bucket.wait_time(now) if self.global_bucket else 0
+                if global_wait > 0:
+                    waiting.append(waiter)
+                    next_try = global_wait if next_try is None else min(next_try, global_wait)
+                    continue
+                room_bucket = self.get_room_bucket(waiter[2])
+                room_wait = room_bucket.wait_time(now) if room_bucket else 0
+                if room_wait > 0:
+                    waiting.append(waiter)
+                    next_try = room_wait if next_try is None else min(next_try, room_wait)
+                    continue
+                if self.global_bucket:
+                    self.global_bucket.take()
+                if room_bucket:
+                    room_bucket.take()
+                future.set_result(None)
+            heapq.heapify(waiting)
+            self.waiters = waiting
+            self.prune(now)
+        if self.waiters and next_try is not None:
+            self.timer = asyncio.get_event_loop().call_later(next_try, self.grant)
+
+    # Rooms whose bucket refilled completely behave like new ones, their bucket isn't needed anymore
+    def prune(self, now: float) -> None:
+        waiting_rooms = {waiter[2] for waiter in self.waiters}
+        for room_id, bucket in list(self.room_buckets.items()):
+            if room_id not in waiting_rooms and bucket.is_full(now):
+                del self.room_buckets[room_id]
+
+    def stop(self) -> None:
+        if self.timer:
+            self.timer.cancel()
+        for waiter in self.waiters:
+            waiter[3].cancel()
+        self.waiters = []
@@ -1,34 +1,40 @@
+import asyncio
 import re
-from base64 import b64decode
 from datetime import datetime, timedelta
 from enum import Enum
-from io import BytesIO
-from typing import Optional
+from typing import Awaitable, Callable, Optional, Union, Tuple, TypeVar
 
 import pytz
-from PIL import Image as pil_image
 from markdown import markdown
 from maubot import Plugin
 from maubot.matrix import MaubotMessageEvent
-from mautrix.crypto.attachments import encrypt_attachment
-from mautrix.errors.request import MForbidden
-from mautrix.types import TextMessageEventContent, Format, MessageType, RoomID, PaginationDirection, \
-    MessageEventContent, EventID, MediaMessageEventContent, ImageInfo, EventType, ThumbnailInfo
+from mautrix.errors.request import MForbidden, MNotFound
+from mautrix.types import TextMessageEventContent, Format, MessageType, RoomID, EventID, \
+    MediaMessageEventContent, ImageInfo, EventType, ThumbnailInfo, EncryptedFile
 
-from .db import LifetimeEnd
+from .db import LifetimeEnd, IdentifierEvent, CachedMedia
+from .history import HistorySearch
+from .media import ProcessedImage, process_image, decode_image, get_thumbnail_variant
+from .metrics import type_label
+from .ratelimit import Priority, is_rate_limited, get_backoff
+
+T = TypeVar("T")
 
 
 class Image:
-    content: str
+    content: Union[str, bytes, bytearray]  # base64 string from JSON pushes, raw bytes from uploads
     content_type: str
     name: str
     thumbnail_size: int
+    # Pushes to a room group share the Image, the first room uploads and the others wait for it
+    upload: Optional[asyncio.Future]
 
-    def __init__(self, content: str, content_type: str, name: str, thumbnail_size: int):
+    def __init__(self, content: Union[str, bytes, bytearray], content_type: str, name: str, thumbnail_size: int):
         self.content = content
         self.content_type = content_type
         self.name = name
         self.thumbnail_size = thumbnail_size
+        self.upload = None
 
 
 class RoomPosterType(Enum):
@@ -58,10 +64,13 @@ class RoomPoster:
     identifier: str
     callback_url: str
     message: str
-    lifetime: int
+    lifetime: int  # seconds, -1 disables self-deletion
+    priority: Priority
+    merged: int  # number of earlier pushes that were coalesced into this one
 
     def __init__(self, hasswebhook: Plugin, identifier: str, rp_type: RoomPosterType, room_id: str,
-                 image: Optional[Image] = None, message="", callback_url="", lifetime=-1):
+                 image: Optional[Image] = None, message="", callback_url="", lifetime=-1,
+                 priority: Optional[Priority] = None):
         self.rp_type = rp_type
         self.room_id = RoomID(room_id)
         self.hasswebhook = hasswebhook
@@ -70,14 +79,62 @@ class RoomPoster:
         self.message = message
         self.lifetime = lifetime
         self.image = image
+        if priority is None:
+            priority = Priority.HIGH if rp_type in (RoomPosterType.MESSAGE, RoomPosterType.IMAGE) else Priority.NORMAL
+        self.priority = priority
+        self.merged = 0
 
-    # Send a POST as a callback containing the event_id of the sent message
+    # Send a POST as a callback containing the event_id of the sent message. Delivery happens in the background.
     async def callback(self, event_id: str) -> None:
         if self.callback_url:
-            await self.hasswebhook.http.post(self.callback_url, json={'event_id': event_id})
+            payload = {'event_id': event_id}
+            if self.merged:
+                payload['merged'] = self.merged
+            self.hasswebhook.callbacks.submit(self.callback_url, payload)
+
+    # Remember which event carries the identifier, so later edits, reactions and redactions can skip the crawl
+    async def index_event(self, event_id: EventID) -> None:
+        if self.identifier and "event_id." not in self.identifier:
+            await self.hasswebhook.identifier_db.insert(
+                IdentifierEvent(room_id=self.room_id, identifier=self.identifier, event_id=event_id))
+
+    # Every request for the room (sends, uploads, event fetches and history pages) goes through the rate limiter.
+    # Requests answered with M_LIMIT_EXCEEDED pause all sends with exponential backoff and are tried again.
+    # Each attempt is timed under stage, "send" is kept for the events sent to the room.
+    async def send(self, call: Callable[[], Awaitable[T]], stage: str = "send") -> T:
+        rate_limiter = self.hasswebhook.rate_limiter
+        attempt = 0
+        while True:
+            with self.hasswebhook.metrics.time("ratelimit", self.rp_type):
+                await rate_limiter.acquire(self.room_id, self.priority)
+            try:
+                with self.hasswebhook.metrics.time(stage, self.rp_type):
+                    return await call()
+            except Exception as e:
+                attempt += 1
+                if not is_rate_limited(e) or attempt > self.hasswebhook.get_ratelimit_max_retries():
+                    raise
+                retry_after = get_backoff(attempt)
+                self.hasswebhook.metrics.rate_limited.inc(source=type_label(self.rp_type))
+                self.hasswebhook.log.warning(f"Rate limited sending to {self.room_id}, retrying in {retry_after}s")
+                rate_limiter.pause(retry_after)
 
     # Switch for each RoomPosterType
     async def post_to_room(self):
+        label = type_label(self.rp_type)
+        try:
+            with self.hasswebhook.metrics.request_seconds.time(type=label):
+                result = await self.dispatch()
+        except Exception as e:
+            self.hasswebhook.metrics.failures.inc(type=label)
+            if is_rate_limited(e):
+                self.hasswebhook.metrics.rate_limited.inc(source=label)
+            raise
+        if not result:
+            self.hasswebhook.metrics.failures.inc(type=label)
+        return result
+
+    async def dispatch(self):
         if self.rp_type == RoomPosterType.MESSAGE:
             return await self.post_message()
         if self.rp_type == RoomPosterType.REDACTION:
@@ -92,35 +149,67 @@ class RoomPoster:
 
     async def post_image(self) -> str:
         media_event = MediaMessageEventContent(body=self.image.name, msgtype=MessageType.IMAGE)
+        if not self.image.upload:
+            self.image.upload = asyncio.ensure_future(self.upload_image())
+        # One room going away must not cancel the upload for the others
+        media_event.file, media_event.info = await asyncio.shield(self.image.upload)
+        event_id = await self.send(lambda: self.hasswebhook.client.send_message_event(
+            self.room_id, event_type=EventType.ROOM_MESSAGE, content=media_event))
+        await self.index_event(event_id)
+        await self.callback(event_id)
+        return event_id
 
-        upload_mime = "application/octet-stream"
-        bytes_image = b64decode(self.image.content)
-        encrypted_image, file = encrypt_attachment(bytes_image)
-        file.url = await self.hasswebhook.client.upload_media(encrypted_image, mime_type=upload_mime)
-        media_event.file = file
-
-        img = pil_image.open(BytesIO(bytes_image))
-        image_info = ImageInfo(mimetype=self.image.content_type, height=img.height, width=img.width)
-        media_event.info = image_info
-
-        byt_arr_tn = BytesIO()
-        img.thumbnail((self.image.thumbnail_size, self.image.thumbnail_size), pil_image.ANTIALIAS)
-        img.save(byt_arr_tn, format='PNG')
+    async def upload_media(self, data: bytes, mime_type: str) -> str:
+        return await self.send(lambda: self.hasswebhook.client.upload_media(data, mime_type=mime_type), "upload")
 
-        tn_img = pil_image.open(byt_arr_tn)
-        enc_tn, tn_file = encrypt_attachment(byt_arr_tn.getvalue())
+    # Encrypt and upload image and thumbnail, or reuse an earlier upload of the same image
+    async def upload_image(self) -> Tuple[EncryptedFile, ImageInfo]:
+        upload_mime = "application/octet-stream"
+        loop = asyncio.get_event_loop()
+        thumbnail_format = self.hasswebhook.get_thumbnail_format()
+        thumbnail_quality = self.hasswebhook.get_thumbnail_quality()
+        thumbnail_variant = get_thumbnail_variant(thumbnail_format, thumbnail_quality)
 
-        image_info.thumbnail_info = ThumbnailInfo(mimetype="image/png", height=tn_img.height, width=tn_img.width)
-        tn_file.url = await self.hasswebhook.client.upload_media(enc_tn, mime_type=upload_mime)
-        image_info.thumbnail_file = tn_file
+        # Bounds the number of decoded images held in memory at the same time
+        async with self.hasswebhook.image_semaphore:
+            with self.hasswebhook.metrics.time("decode", self.rp_type):
+                data, content_hash = await loop.run_in_executor(self.hasswebhook.decode_executor, decode_image,
+                                                                self.image.content)
+            cached = await self.hasswebhook.media_cache.get(content_hash, self.image.thumbnail_size,
+                                                            thumbnail_variant)
+            if cached:
+                self.hasswebhook.log.debug(f"Reusing uploaded media for image {content_hash}")
+                image_info = ImageInfo.deserialize(cached.info)
+                image_info.mimetype = self.image.content_type or image_info.mimetype
+                return EncryptedFile.deserialize(cached.file), image_info
 
-        img.close()
-        tn_img.close()
+            processed: ProcessedImage = await loop.run_in_executor(
+                self.hasswebhook.image_executor, process_image, data, self.image.thumbnail_size,
+                thumbnail_format, thumbnail_quality)
+            # Measured inside the worker, which may be another process
+            for stage, seconds in processed.timings.items():
+                self.hasswebhook.metrics.observe(stage, seconds, self.rp_type)
+            if processed.thumbnail_data is None:
+                # Small images are their own thumbnail, so only one file is uploaded
+                processed.file.url = await self.upload_media(processed.data, upload_mime)
+                processed.thumbnail_file = processed.file
+            else:
+                processed.file.url, processed.thumbnail_file.url = await asyncio.gather(
+                    self.upload_media(processed.data, upload_mime),
+                    self.upload_media(processed.thumbnail_data, upload_mime)
+                )
 
-        event_id = await self.hasswebhook.client.send_message_event(self.room_id, event_type=EventType.ROOM_MESSAGE,
-                                                                    content=media_event)
-        await self.callback(event_id)
-        return event_id
+        image_info = ImageInfo(mimetype=self.image.content_type or processed.mimetype, height=processed.height,
+                               width=processed.width)
+        image_info.thumbnail_info = ThumbnailInfo(mimetype=processed.thumbnail_mimetype,
+                                                  height=processed.thumbnail_height, width=processed.thumbnail_width)
+        image_info.thumbnail_file = processed.thumbnail_file
+        await self.hasswebhook.media_cache.put(CachedMedia(content_hash=content_hash,
+                                                           thumbnail_size=self.image.thumbnail_size,
+                                                           thumbnail_variant=thumbnail_variant,
+                                                           file=processed.file.serialize(),
+                                                           info=image_info.serialize()))
+        return processed.file, image_info
 
     # Send message to room
     async def post_message(self):
@@ -133,12 +222,13 @@ class RoomPoster:
             formatted_body=markdown(self.message)
         )
         try:
-            event_id_req = await self.hasswebhook.client.send_message(self.room_id, content)
+            event_id_req = await self.send(lambda: self.hasswebhook.client.send_message(self.room_id, content))
+            await self.index_event(event_id_req)
             await self.callback(event_id_req)
             # Lifetime (self-deletion)
             if self.lifetime != -1:
-                end_time = datetime.now(tz=pytz.UTC) + timedelta(minutes=self.lifetime)
-                self.hasswebhook.db.insert(
+                end_time = datetime.now(tz=pytz.UTC) + timedelta(seconds=self.lifetime)
+                await self.hasswebhook.db.insert(
                     LifetimeEnd(end_date=end_time, room_id=self.room_id, event_id=event_id_req))
             return event_id_req
         except MForbidden:
@@ -150,11 +240,12 @@ class RoomPoster:
         event_id = self.identifier[9:] if ("event_id." in self.identifier) else (
             await self.search_history_for_event()).event_id
         try:
-            event_id_req = await self.hasswebhook.client.redact(
+            event_id_req = await self.send(lambda: self.hasswebhook.client.redact(
                 room_id=self.room_id,
                 event_id=event_id,
                 reason="deactivated"
-            )
+            ))
+            await self.hasswebhook.identifier_db.remove_event(self.room_id, event_id)
             await self.callback(event_id_req)
         except MForbidden:
             self.hasswebhook.log.error("Wrong Room ID")
@@ -172,70 +263,70 @@ class RoomPoster:
             formatted_body=markdown(self.message)
         )
         event: MaubotMessageEvent = await self.search_history_for_event()
-        await event.edit(content=content)
+        await self.send(lambda: event.edit(content=content))
         return True
 
     # React on message
     async def post_reaction(self) -> bool:
         event: MaubotMessageEvent = await self.search_history_for_event()
-        await event.react(key=self.message)
+        await self.send(lambda: event.react(key=self.message))
         return True
 
+    # Look up the last event sent with the identifier in the database, invalidating entries that are gone
+    async def get_indexed_event(self) -> Optional[MaubotMessageEvent]:
+        identifier_event = await self.hasswebhook.identifier_db.get_latest(self.room_id, self.identifier)
+        if not identifier_event:
+            return None
+        try:
+            event = await self.send(lambda: self.hasswebhook.client.get_event(
+                room_id=self.room_id, event_id=identifier_event.event_id), "get_event")
+        except MNotFound:
+            await self.hasswebhook.identifier_db.remove_event(self.room_id, identifier_event.event_id)
+            return None
+        except Exception:
+            # Keep the entry, a rate limit or an unreachable homeserver doesn't mean the event is gone
+            self.hasswebhook.log.warning(f"Indexed event {identifier_event.event_id} could not be fetched")
+            return None
+        if not event:
+            # The client returns None when decrypting fails, the session may just not have arrived yet
+            self.hasswebhook.log.warning(f"Indexed event {identifier_event.event_id} could not be decrypted")
+            return None
+        if not getattr(event.content, "body", None):
+            # Redacted
+            await self.hasswebhook.identifier_db.remove_event(self.room_id, identifier_event.event_id)
+            return None
+        self.hasswebhook.log.debug(f"Found indexed message_event: {identifier_event.event_id}")
+        return MaubotMessageEvent(base=event, client=self.hasswebhook.client)
+
     # Search in room history for a message containing the identifier and return the event of that message
     async def search_history_for_event(self) -> Optional[MaubotMessageEvent]:
         if "event_id." in self.identifier:
             event_id = EventID(self.identifier[9:])
-            message_event = await self.hasswebhook.client.get_event(room_id=self.room_id, event_id=event_id)
-            self.hasswebhook.log.info(
-                f"[search_history_for_event] event_id: {event_id}: message_event: {message_event}")
+            message_event = await self.send(lambda: self.hasswebhook.client.get_event(
+                room_id=self.room_id, event_id=event_id), "get_event")
             if not message_event:
                 self.hasswebhook.log.error("Could not find a matching event for event_id.")
+            else:
+                # Lazy and cut short, the whole event is too much for every edit, reaction and redaction
+                self.hasswebhook.log.debug("Fetched %s from %s for %s, body: %.100r", message_event.type,
+                                           message_event.sender, event_id,
+                                           getattr(message_event.content, "body", None))
             return message_event
 
-        self.hasswebhook.log.debug(f"Searching for message_event... {self.identifier}")
-        sync_result = await self.hasswebhook.client.sync()
-        prev_batch = sync_result.get("rooms").get("join").get(
-            self.room_id).get("timeline").get("prev_batch")
-        encrypted_eventlist = []
-        get_messages_result_FW = await self.hasswebhook.client.get_messages(
-            room_id=self.room_id,
-            direction=PaginationDirection.FORWARD,
-            from_token=prev_batch,
-            limit=100
-        )
-        encrypted_eventlist.extend(get_messages_result_FW.events)
-        encrypted_eventlist = list(reversed(encrypted_eventlist))
+        message_event = await self.get_indexed_event()
+        if message_event:
+            return message_event
 
-        start = get_messages_result_FW.start
-        for x in range(10):
-            get_messages_result_BW = await self.hasswebhook.client.get_messages(
-                room_id=self.room_id,
-                direction=PaginationDirection.BACKWARD,
-                from_token=start,
-                limit=100
-            )
-            encrypted_eventlist.extend(get_messages_result_BW.events)
-            start = get_messages_result_BW.end
-
-        eventlist = []
-        for encrypted_event in encrypted_eventlist:
-            try:
-                event = await self.hasswebhook.client.crypto.decrypt_megolm_event(encrypted_event)
-                if event.sender == self.hasswebhook.client.mxid:
-                    eventlist.append(event)
-            except:
-                continue
-
-        message_event: MaubotMessageEvent = None
-        for event in eventlist:
-            evt_content: MessageEventContent = event.content
-            if self.identifier in evt_content.body:
-                message_event = MaubotMessageEvent(
-                    base=event, client=self.hasswebhook.client)
-                break
-        if not message_event:
+        self.hasswebhook.log.debug(f"Searching for message_event... {self.identifier}")
+        search = HistorySearch(self.hasswebhook.client, self.room_id, self.hasswebhook.log,
+                               depth=self.hasswebhook.get_history_search_depth(),
+                               page_size=self.hasswebhook.get_history_page_size(), rp_type=self.rp_type,
+                               metrics=self.hasswebhook.metrics, send=self.send)
+        event = await search.find(lambda evt: self.identifier in (getattr(evt.content, "body", None) or ""))
+        if not event:
             self.hasswebhook.log.error("Could not find a matching event.")
             return
+        message_event = MaubotMessageEvent(base=event, client=self.hasswebhook.client)
 
         self.hasswebhook.log.debug(f"Found message_event: {message_event.event_id}")
         return message_event
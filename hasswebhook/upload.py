@@ -0,0 +1,79 @@
+from typing import Dict, Optional
+
+from aiohttp import BodyPartReader
+from aiohttp.web import Request
+
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class Upload:
+    data: Optional[bytearray]
+    content_type: Optional[str]
+    filename: Optional[str]
+    fields: Dict[str, str]
+
+    def __init__(self, data: Optional[bytearray] = None, content_type: Optional[str] = None,
+                 filename: Optional[str] = None, fields: Optional[Dict[str, str]] = None):
+        self.data = data
+        self.content_type = content_type
+        self.filename = filename
+        self.fields = fields or {}
+
+
+def is_upload(req: Request) -> bool:
+    return req.content_type.startswith("image/") or req.content_type == "multipart/form-data"
+
+
+# Raw image bodies carry their parameters in the query string, multipart bodies in form fields
+async def read_upload(req: Request, max_size: int) -> Upload:
+    if req.content_type == "multipart/form-data":
+        return await read_multipart(req, max_size)
+    if req.content_length and req.content_length > max_size:
+        raise UploadTooLarge()
+    data = await read_limited(req.content.iter_chunked(CHUNK_SIZE), max_size)
+    return Upload(data=data, content_type=req.content_type, filename=req.query.get("name"), fields=dict(req.query))
+
+
+# All parts, form fields included, share the size limit
+async def read_multipart(req: Request, max_size: int) -> Upload:
+    if req.content_length and req.content_length > max_size:
+        raise UploadTooLarge()
+    upload = Upload(fields=dict(req.query))
+    remaining = max_size
+    reader = await req.multipart()
+    while True:
+        part = await reader.next()
+        if part is None:
+            return upload
+        if not isinstance(part, BodyPartReader):
+            continue
+        data = await read_limited(iter_part(part), remaining)
+        remaining -= len(data)
+        if part.filename or part.headers.get("Content-Type", "").startswith("image/"):
+            upload.data = data
+            upload.content_type = part.headers.get("Content-Type")
+            upload.filename = part.filename
+        else:
+            upload.fields[part.name] = data.decode(part.get_charset("utf-8"))
+
+
+async def iter_part(part: BodyPartReader):
+    while True:
+        chunk = await part.read_chunk(CHUNK_SIZE)
+        if not chunk:
+            return
+        yield chunk
+
+
+# Reads the body chunk by chunk into a single buffer, which is handed on without further copies
+async def read_limited(chunks, max_size: int) -> bytearray:
+    data = bytearray()
+    async for chunk in chunks:
+        if len(data) + len(chunk) > max_size:
+            raise UploadTooLarge()
+        data += chunk
+    return data
@@ -0,0 +1,104 @@
+import asyncio
+import time
+from logging import Logger
+from typing import Iterable, List, Optional
+
+from attr import dataclass, asdict
+from mautrix.client import Client
+from mautrix.errors import MNotFound
+from mautrix.types import EventType, RoomID
+
+
+@dataclass
+class WarmupStats:
+    rooms: int = 0
+    done: int = 0
+    failed: int = 0
+    encrypted: int = 0
+    sessions_shared: int = 0
+    running: bool = False
+    seconds: Optional[float] = None
+    # Set when the warm-up couldn't start, e.g. because the recent rooms couldn't be read
+    error: Optional[str] = None
+
+    def as_dict(self) -> dict:
+        return asdict(self)
+
+
+# Prepares rooms before the first push arrives, so that push doesn't wait for the encryption state, the member
+# list, device key queries and a new megolm session. Pushes that arrive while a room is still being prepared
+# wait for the session that is being shared instead of sharing another one.
+class Warmup:
+    client: Client
+    concurrency: int
+    log: Logger
+    stats: WarmupStats
+
+    def __init__(self, client: Client, log: Logger, concurrency: int = 4) -> None:
+        self.client = client
+        self.concurrency = concurrency
+        self.log = log
+        self.stats = WarmupStats()
+
+    async def run(self, room_ids: Iterable[RoomID]) -> None:
+        room_ids = list(dict.fromkeys(room_ids))
+        if not room_ids:
+            return
+        self.stats.rooms = len(room_ids)
+        self.stats.running = True
+        self.log.info(f"Warming up {len(room_ids)} rooms")
+        start = time.monotonic()
+        semaphore = asyncio.Semaphore(max(1, self.concurrency))
+
+        async def warm_up_limited(room_id: RoomID) -> None:
+            async with semaphore:
+                await self.warm_up(room_id)
+
+        try:
+            await asyncio.gather(*(warm_up_limited(room_id) for room_id in room_ids))
+        finally:
+            self.stats.running = False
+            self.stats.seconds = round(time.monotonic() - start, 3)
+        self.log.info(f"Warm-up finished: {self.stats.as_dict()}")
+
+    async def warm_up(self, room_id: RoomID) -> None:
+        try:
+            members = await self.client.get_joined_members(room_id)
+            if await self.is_encrypted(room_id):
+                self.stats.encrypted += 1
+                if await self.needs_session(room_id):
+                    # Queries the device keys of all members and sends them the session
+                    await self.client.share_group_session(room_id)
+                    self.stats.sessions_shared += 1
+            self.stats.done += 1
+            self.log.debug(f"Warmed up {room_id} with {len(members)} members "
+                           f"({self.stats.done + self.stats.failed}/{self.stats.rooms})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.stats.failed += 1
+            self.log.warning(f"Warming up {room_id} failed: {e!r}")
+
+    # Also stores the answer in the state store, so the first send doesn't have to ask the homeserver
+    async def is_encrypted(self, room_id: RoomID) -> bool:
+        state_store = self.client.state_store
+        encrypted = await state_store.is_encrypted(room_id) if state_store else None
+        if encrypted is None:
+            try:
+                await self.client.get_state_event(room_id, EventType.ROOM_ENCRYPTION)
+                encrypted = True
+            except MNotFound:
+                encrypted = False
+        return encrypted and self.client.crypto is not None
+
+    async def needs_session(self, room_id: RoomID) -> bool:
+        session = await self.client.crypto.crypto_store.get_outbound_group_session(room_id)
+        return not session or not session.shared or session.expired
+
+
+def get_warmup_rooms(configured: List[str], groups: Optional[dict], recent: List[RoomID]) -> List[RoomID]:
+    room_ids = [RoomID(room_id) for room_id in configured or []]
+    for group in (groups or {}).values():
+        room_ids.extend(RoomID(room_id) for room_id in group or [])
+    room_ids.extend(recent)
+    return list(dict.fromkeys(room_ids))
@@ -0,0 +1,72 @@
+import asyncio
+
+from hasswebhook.batch import run_batch, run_fanout
+from hasswebhook.roomposter import RoomPosterType
+
+
+class FakeRoomPoster:
+    def __init__(self, log: list, name: str, rp_type: RoomPosterType, identifier: str = "",
+                 delay: float = 0, room_id: str = "!room:example.com") -> None:
+        self.log = log
+        self.name = name
+        self.rp_type = rp_type
+        self.identifier = identifier
+        self.delay = delay
+        self.room_id = room_id
+
+    async def post_to_room(self) -> str:
+        self.log.append(f"start {self.name}")
+        await asyncio.sleep(self.delay)
+        if self.name.startswith("fail"):
+            raise ValueError(self.name)
+        self.log.append(f"done {self.name}")
+        return f"$event-{self.name}"
+
+
+def test_edit_waits_for_its_message():
+    log = []
+    results = asyncio.run(run_batch([
+        FakeRoomPoster(log, "message", RoomPosterType.MESSAGE, "door", delay=0.02),
+        FakeRoomPoster(log, "edit", RoomPosterType.EDIT, "door"),
+    ]))
+    assert log == ["start message", "done message", "start edit", "done edit"]
+    assert results == ["$event-message", "$event-edit"]
+
+
+def test_new_events_keep_the_batch_order():
+    log = []
+    asyncio.run(run_batch([
+        FakeRoomPoster(log, "first", RoomPosterType.MESSAGE, delay=0.02),
+        FakeRoomPoster(log, "image", RoomPosterType.IMAGE, delay=0.01),
+        FakeRoomPoster(log, "second", RoomPosterType.MESSAGE),
+    ]))
+    assert log == ["start first", "done first", "start image", "done image", "start second", "done second"]
+
+
+def test_unrelated_operations_run_concurrently():
+    log = []
+    asyncio.run(run_batch([
+        FakeRoomPoster(log, "message", RoomPosterType.MESSAGE, "door", delay=0.02),
+        FakeRoomPoster(log, "reaction", RoomPosterType.REACTION, "window"),
+    ]))
+    assert log.index("done reaction") < log.index("done message")
+
+
+def test_failed_operation_does_not_stop_the_others():
+    log = []
+    results = asyncio.run(run_batch([
+        FakeRoomPoster(log, "fail", RoomPosterType.MESSAGE, "door"),
+        FakeRoomPoster(log, "edit", RoomPosterType.EDIT, "door"),
+    ]))
+    assert isinstance(results[0], ValueError)
+    assert results[1] == "$event-edit"
+
+
+def test_fanout_returns_a_result_per_room():
+    log = []
+    room_posters = [FakeRoomPoster(log, name, RoomPosterType.MESSAGE, room_id=f"!{name}:example.com")
+                    for name in ("a", "fail", "c")]
+    results = asyncio.run(run_fanout(room_posters, concurrency=2, run=lambda room_poster: room_poster.post_to_room()))
+    assert results["!a:example.com"] == "$event-a"
+    assert isinstance(results["!fail:example.com"], ValueError)
+    assert results["!c:example.com"] == "$event-c"
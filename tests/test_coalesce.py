@@ -0,0 +1,63 @@
+import asyncio
+import logging
+
+from hasswebhook.coalesce import Coalescer
+from hasswebhook.roomposter import RoomPosterType
+
+
+class FakeRoomPoster:
+    def __init__(self, sent: list, rp_type: RoomPosterType, message: str, delay: float = 0) -> None:
+        self.sent = sent
+        self.room_id = "!room:example.com"
+        self.identifier = "door"
+        self.rp_type = rp_type
+        self.message = message
+        self.delay = delay
+        self.merged = 0
+
+    async def post_to_room(self) -> str:
+        self.sent.append(("start", self.message))
+        await asyncio.sleep(self.delay)
+        self.sent.append(("done", self.message))
+        return f"$event-{self.message}"
+
+
+def test_edit_waits_for_message():
+    async def run() -> list:
+        sent = []
+        coalescer = Coalescer(logging.getLogger("test"), window=0.01)
+        message = FakeRoomPoster(sent, RoomPosterType.MESSAGE, "open", delay=0.05)
+        edit = FakeRoomPoster(sent, RoomPosterType.EDIT, "closed")
+        await asyncio.gather(coalescer.run(message), coalescer.run(edit))
+        return sent
+
+    assert asyncio.run(run()) == [("start", "open"), ("done", "open"), ("start", "closed"), ("done", "closed")]
+
+
+def test_edits_in_window_are_merged():
+    async def run() -> tuple:
+        sent = []
+        coalescer = Coalescer(logging.getLogger("test"), window=0.01)
+        edits = [FakeRoomPoster(sent, RoomPosterType.EDIT, str(i)) for i in range(3)]
+        results = await asyncio.gather(*(coalescer.run(edit) for edit in edits))
+        return sent, results, edits[-1].merged
+
+    sent, results, merged = asyncio.run(run())
+    assert sent == [("start", "2"), ("done", "2")]
+    assert results == ["$event-2"] * 3
+    assert merged == 2
+
+
+def test_window_waits_for_its_turn():
+    async def run() -> list:
+        sent = []
+        coalescer = Coalescer(logging.getLogger("test"), window=0.01)
+        turn = asyncio.get_event_loop().create_future()
+        edit = asyncio.ensure_future(coalescer.run(FakeRoomPoster(sent, RoomPosterType.EDIT, "closed"), turn))
+        await asyncio.sleep(0.05)
+        sent.append(("turn", None))
+        turn.set_result(None)
+        await edit
+        return sent
+
+    assert asyncio.run(run()) == [("turn", None), ("start", "closed"), ("done", "closed")]
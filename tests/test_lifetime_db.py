@@ -0,0 +1,101 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+from sqlalchemy import create_engine
+
+from hasswebhook.db import LifetimeDatabase, LifetimeEnd
+
+LEASE = timedelta(seconds=30)
+
+
+@pytest.fixture
+def db(tmp_path) -> LifetimeDatabase:
+    # A file, in-memory SQLite databases aren't shared between the executor threads
+    return LifetimeDatabase(create_engine(f"sqlite:///{tmp_path / 'lifetime.db'}"))
+
+
+def insert_due(db: LifetimeDatabase, now: datetime, count: int) -> None:
+    asyncio.run(db.insert_many([LifetimeEnd(end_date=now - timedelta(seconds=i), room_id="!room:example.com",
+                                            event_id=f"$event{i}") for i in range(count)]))
+
+
+def claim(db: LifetimeDatabase, owner: str, now: datetime, limit: int = 100) -> list:
+    return asyncio.run(db.claim_due(owner, now, now + LEASE, limit))
+
+
+def test_concurrent_claims_are_disjoint(db):
+    now = datetime.now(tz=pytz.UTC)
+    insert_due(db, now, 10)
+
+    async def claim_both() -> tuple:
+        return await asyncio.gather(db.claim_due("a", now, now + LEASE, 6), db.claim_due("b", now, now + LEASE, 6))
+
+    a, b = asyncio.run(claim_both())
+    assert not {row.id for row in a} & {row.id for row in b}
+    assert len(a) + len(b) == 10
+    assert {row.owner for row in a} == {"a"} and {row.owner for row in b} == {"b"}
+
+
+def test_rows_not_due_are_not_claimed(db):
+    now = datetime.now(tz=pytz.UTC)
+    asyncio.run(db.insert(LifetimeEnd(end_date=now + timedelta(minutes=5), room_id="!room:example.com",
+                                      event_id="$later")))
+    assert claim(db, "a", now) == []
+    assert [row.event_id for row in claim(db, "a", now + timedelta(minutes=6))] == ["$later"]
+
+
+def test_claims_come_oldest_first_up_to_the_limit(db):
+    now = datetime.now(tz=pytz.UTC)
+    insert_due(db, now, 5)
+    claimed = claim(db, "a", now, limit=3)
+    assert [row.event_id for row in claimed] == ["$event4", "$event3", "$event2"]
+
+
+def test_expired_lease_is_reclaimed(db):
+    now = datetime.now(tz=pytz.UTC)
+    insert_due(db, now, 3)
+    assert len(claim(db, "a", now)) == 3
+    assert claim(db, "b", now + LEASE / 2) == []
+    reclaimed = claim(db, "b", now + LEASE * 2)
+    assert len(reclaimed) == 3
+    assert {row.owner for row in reclaimed} == {"b"}
+
+
+def test_deferred_row_waits_for_its_retry(db):
+    now = datetime.now(tz=pytz.UTC)
+    insert_due(db, now, 2)
+    first, second = claim(db, "a", now)
+    retry_at = now + timedelta(minutes=10)
+    asyncio.run(db.defer(first, "a", retry_at))
+
+    # The other row's lease ran out, the deferred one is held until its retry is due
+    assert [row.id for row in claim(db, "b", now + LEASE * 2)] == [second.id]
+    assert first.id in [row.id for row in claim(db, "c", retry_at + timedelta(seconds=1))]
+
+
+def test_defer_needs_the_lease(db):
+    now = datetime.now(tz=pytz.UTC)
+    insert_due(db, now, 1)
+    lifetime_end, = claim(db, "a", now)
+    asyncio.run(db.defer(lifetime_end, "b", now + timedelta(minutes=10)))
+    assert len(claim(db, "c", now + LEASE * 2)) == 1
+
+
+def test_released_rows_can_be_claimed_right_away(db):
+    now = datetime.now(tz=pytz.UTC)
+    insert_due(db, now, 4)
+    claimed = claim(db, "a", now)
+    asyncio.run(db.release([row.id for row in claimed[:2]], "a"))
+    # Only the owner can release its rows
+    asyncio.run(db.release([row.id for row in claimed[2:]], "b"))
+    assert [row.id for row in claim(db, "b", now)] == [row.id for row in claimed[:2]]
+
+
+def test_removed_rows_are_gone(db):
+    now = datetime.now(tz=pytz.UTC)
+    insert_due(db, now, 3)
+    claimed = claim(db, "a", now)
+    asyncio.run(db.remove_ids([row.id for row in claimed[:2]]))
+    assert [row.id for row in asyncio.run(db.get_all())] == [claimed[2].id]
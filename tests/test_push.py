@@ -0,0 +1,25 @@
+import pytest
+
+from hasswebhook.push import InvalidPush, parse_lifetime
+
+
+@pytest.mark.parametrize("lifetime, seconds", [
+    (None, -1),
+    ("", -1),
+    (5, 300),
+    ("5", 300),
+    (1.5, 90),
+    ("30s", 30),
+    ("10m", 600),
+    (" 2H ", 7200),
+    ("1d", 86400),
+    (-3, -1),
+])
+def test_parse_lifetime(lifetime, seconds):
+    assert parse_lifetime(lifetime) == seconds
+
+
+@pytest.mark.parametrize("lifetime", ["soon", "5x", "s", [5]])
+def test_parse_lifetime_rejects_garbage(lifetime):
+    with pytest.raises(InvalidPush):
+        parse_lifetime(lifetime)
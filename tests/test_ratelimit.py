@@ -0,0 +1,65 @@
+import asyncio
+
+from hasswebhook.ratelimit import Priority, RateLimiter, get_backoff
+
+
+async def acquire_all(limiter: RateLimiter, requests: list) -> list:
+    granted = []
+
+    async def acquire(name: str, room_id: str, priority: Priority) -> None:
+        await limiter.acquire(room_id, priority)
+        granted.append(name)
+
+    await asyncio.gather(*(acquire(*request) for request in requests))
+    return granted
+
+
+def test_waiting_sends_go_by_priority_then_age():
+    async def run() -> list:
+        limiter = RateLimiter()
+        # Holds everything back until all sends are waiting
+        limiter.pause(0.05)
+        granted = await acquire_all(limiter, [
+            ("low", "!a:example.com", Priority.LOW),
+            ("normal 1", "!a:example.com", Priority.NORMAL),
+            ("high", "!b:example.com", Priority.HIGH),
+            ("normal 2", "!b:example.com", Priority.NORMAL),
+        ])
+        limiter.stop()
+        return granted
+
+    assert asyncio.run(run()) == ["high", "normal 1", "normal 2", "low"]
+
+
+def test_global_rate_is_shared_in_priority_order():
+    async def run() -> list:
+        limiter = RateLimiter(rate=50, burst=1)
+        granted = await acquire_all(limiter, [
+            ("first", "!a:example.com", Priority.LOW),
+            ("low", "!a:example.com", Priority.LOW),
+            ("high", "!b:example.com", Priority.HIGH),
+        ])
+        limiter.stop()
+        return granted
+
+    # The first one takes the only token, the others wait for the next ones
+    assert asyncio.run(run()) == ["first", "high", "low"]
+
+
+def test_room_without_budget_does_not_hold_up_others():
+    async def run() -> list:
+        limiter = RateLimiter(room_rate=20, room_burst=1)
+        granted = await acquire_all(limiter, [
+            ("a 1", "!a:example.com", Priority.HIGH),
+            ("a 2", "!a:example.com", Priority.HIGH),
+            ("b", "!b:example.com", Priority.LOW),
+        ])
+        limiter.stop()
+        return granted
+
+    assert asyncio.run(run()) == ["a 1", "b", "a 2"]
+
+
+def test_backoff_doubles_up_to_the_cap():
+    assert [get_backoff(attempt) for attempt in range(1, 5)] == [1, 2, 4, 8]
+    assert get_backoff(20) == 60